@@ -3,6 +3,7 @@ Run with `streamlit run Home.py`
 """
 
 import streamlit as st
+from custom_functions import get_connection, start_prewarm
 
 st.set_page_config(
     # page_icon="🏠",
@@ -15,6 +16,10 @@ st.info('Choose a practice from the sidebar', icon='ℹ️')
 
 st.write(f'User: {st.experimental_user.email}')
 
+# Start loading the latest periods of every practice into the shared cache, once per server process,
+# so the practice pages open warm
+start_prewarm(get_connection())
+
 roles = {
     'Management': st.secrets['management_emails'],
     'Crypto law': st.secrets['crypto_law_emails'],
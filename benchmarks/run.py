@@ -0,0 +1,221 @@
+"""
+Benchmarks of the report computations on synthetic exports.
+
+Run from the repository root:
+    python benchmarks/run.py                          # 10k, 100k and 1M rows, compared with benchmarks/baseline.json
+    python benchmarks/run.py --sizes 10M --only create_margin_table
+    python benchmarks/run.py --save-baseline          # store the results as the new baseline
+
+Every benchmark is timed with time.perf_counter (best and median of --repeat runs) and its peak
+Python memory is measured with tracemalloc in a separate run. The size is the number of MP rows
+(RR gets half of it) or, for the dynamic report, the number of margin table rows.
+
+benchmarks/baseline.json is a post-change reference: it was recorded with the optimized code (most of the
+benchmarked functions don't exist before it), so it catches regressions but shows no before/after.
+"""
+
+import argparse
+import io
+import json
+import os
+import pickle
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd  # noqa: E402
+import custom_functions as cf  # noqa: E402
+from synthetic import (REVENUE_COLUMN, SALARY_COLUMN, make_dynamic_payload,  # noqa: E402
+                       make_period)
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+DEFAULT_SIZES = '10k,100k,1M'
+
+# Figures with one bar per row are only built up to this size, plotly can't draw more anyway
+FIGURE_MAX_ROWS = 100_000
+
+
+# Inputs of the benchmarks, generated once per size
+def exports_data(rows):
+    MP, RR = make_period(rows)
+    return {'MP': MP, 'RR': RR,
+            'margin_table': cf.create_margin_table(RR, MP, REVENUE_COLUMN, SALARY_COLUMN)}
+
+
+def dynamic_data(rows):
+    payload = make_dynamic_payload(rows)
+    full_table, main_stats = cf.pkl_to_two_dfs(payload)
+    return {'payload': payload, 'full_table': full_table, 'main_stats': main_stats,
+            'pickle': pickle.dumps(payload), 'store': cf.encode_dynamic_store(payload),
+            'last_periods': list(payload)[-4:]}
+
+
+DATA = {'exports': exports_data, 'dynamic': dynamic_data}
+
+# The cached functions are called undecorated, the benchmarks measure the computation and not the cache
+rank_client_revenue = cf.rank_client_revenue.__wrapped__
+
+# name: (input data, function of the data, largest size it runs at)
+BENCHMARKS = {
+    'create_margin_table': ('exports', lambda data: cf.create_margin_table(
+        data['RR'], data['MP'], REVENUE_COLUMN, SALARY_COLUMN), None),
+    'build_period_cube': ('exports', lambda data: cf.build_period_cube(
+        data['MP'], data['RR'], REVENUE_COLUMN, SALARY_COLUMN), None),
+    'client_ranking': ('exports', lambda data: rank_client_revenue(
+        data['RR'], REVENUE_COLUMN, 'All'), None),
+    'hours_by_practice_figure': ('exports', lambda data: cf._hours_by_practice_figure(data['MP']), None),
+    'salary_and_collected_time_figure': ('exports', lambda data: cf._salary_and_collected_time_figure(
+        data['margin_table'], SALARY_COLUMN, REVENUE_COLUMN, ' USD'), None),
+    'pkl_to_two_dfs': ('dynamic', lambda data: cf.pkl_to_two_dfs(data['payload']), None),
+    'dynamic_pickle_load': ('dynamic', lambda data: pickle.loads(data['pickle']), None),
+    'dynamic_store_encode': ('dynamic', lambda data: cf.encode_dynamic_store(data['payload']), None),
+    'dynamic_store_read': ('dynamic', lambda data: cf.read_dynamic_store(io.BytesIO(data['store'])), None),
+    'dynamic_store_read_last_year': ('dynamic', lambda data: cf.read_dynamic_store(
+        io.BytesIO(data['store']), periods=data['last_periods']), None),
+    'build_yearly_table': ('dynamic', lambda data: cf.build_yearly_table(data['full_table']), None),
+    'salaries_vs_revenue_figure': ('dynamic', lambda data: cf._salaries_vs_revenue_figure(
+        data['main_stats'], 'total_collected_time', 'total_salaries'), None),
+    'cost_vs_collected_time_v5_figure': ('dynamic', lambda data: cf._cost_vs_collected_time_v5_figure(
+        data['full_table'], SALARY_COLUMN, REVENUE_COLUMN), FIGURE_MAX_ROWS),
+    'years_stacked_figure': ('dynamic', lambda data: cf._years_stacked_figure(data['full_table']), None),
+    'waterfall_figure': ('dynamic', lambda data: cf._waterfall_figure(data['full_table']), None),
+}
+
+
+# "10k" -> 10000, "1M" -> 1000000
+def parse_size(text):
+    multipliers = {'k': 1_000, 'm': 1_000_000}
+    text = text.strip().lower()
+    if text[-1] in multipliers:
+        return int(float(text[:-1]) * multipliers[text[-1]])
+    return int(text)
+
+
+def format_size(rows):
+    for suffix, multiplier in (('M', 1_000_000), ('k', 1_000)):
+        if rows >= multiplier and rows % multiplier == 0:
+            return f'{rows // multiplier}{suffix}'
+    return str(rows)
+
+
+def measure(function, data, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(data)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function(data)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {'seconds': min(timings), 'median_seconds': statistics.median(timings),
+            'peak_mb': peak / 2**20}
+
+
+def run(sizes, names, repeat):
+    results = {}
+    for rows in sizes:
+        for kind, make_data in DATA.items():
+            selected = [name for name in names if BENCHMARKS[name][0] == kind]
+            if not selected:
+                continue
+            data = make_data(rows)
+            for name in selected:
+                _, function, max_rows = BENCHMARKS[name]
+                key = f'{name}@{format_size(rows)}'
+                if max_rows is not None and rows > max_rows:
+                    print(f'{key:<45} skipped (above {format_size(max_rows)} rows)')
+                    continue
+                results[key] = measure(function, data, repeat)
+                print(f"{key:<45} {results[key]['seconds']:>10.4f} s {results[key]['peak_mb']:>10.1f} MB",
+                      flush=True)
+            del data
+    return results
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get('results', {})
+
+
+def save_baseline(path, results):
+    # Entries that weren't run this time are kept
+    baseline = load_baseline(path)
+    baseline.update(results)
+    note = None
+    if os.path.exists(path):
+        with open(path) as f:
+            note = json.load(f).get('note')
+    with open(path, 'w') as f:
+        json.dump({**({'note': note} if note else {}),
+                   'machine': {'python': platform.python_version(), 'pandas': pd.__version__,
+                               'platform': platform.platform(), 'processor': platform.processor()},
+                   'results': dict(sorted(baseline.items()))}, f, indent=2)
+        f.write('\n')
+
+
+# Ratios against the baseline (below 1 is faster / smaller), returns the keys that got slower
+def compare(results, baseline, tolerance):
+    rows = []
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        time_ratio = result['seconds'] / baseline[key]['seconds']
+        memory_ratio = result['peak_mb'] / baseline[key]['peak_mb'] if baseline[key]['peak_mb'] else float('nan')
+        if time_ratio > 1 + tolerance:
+            status = 'slower'
+            regressions.append(key)
+        elif time_ratio < 1 - tolerance:
+            status = 'faster'
+        else:
+            status = 'same'
+        rows.append({'benchmark': key, 'seconds': result['seconds'], 'baseline seconds': baseline[key]['seconds'],
+                     'time x': time_ratio, 'peak MB': result['peak_mb'],
+                     'baseline peak MB': baseline[key]['peak_mb'], 'memory x': memory_ratio, 'status': status})
+
+    if rows:
+        print()
+        print(pd.DataFrame(rows).to_string(index=False, float_format='{:.3f}'.format))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help=f'comma separated row counts, e.g. 10k,1M,10M (default {DEFAULT_SIZES})')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS),
+                        help='benchmarks to run (default all)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per benchmark (default 3)')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='baseline file (default benchmarks/baseline.json)')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results in the baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='time change that counts as faster/slower (default 0.2 = 20%%)')
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help='exit with status 1 if a benchmark got slower than the baseline')
+    args = parser.parse_args()
+
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    results = run(sizes, args.only, args.repeat)
+
+    regressions = compare(results, load_baseline(args.baseline), args.tolerance)
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print(f'\nBaseline saved to {args.baseline}')
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
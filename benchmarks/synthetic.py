@@ -0,0 +1,117 @@
+"""
+Synthetic Clio exports for the benchmarks.
+
+The frames have the columns of the real MP (Matter Productivity by User) and RR (Revenue Report) exports
+in the schema the app loads them with (apply_period_schema), so the benchmarks measure the same work
+the pages do.
+"""
+
+import numpy as np
+import pandas as pd
+
+REVENUE_COLUMN = 'USD Collected Time'
+SALARY_COLUMN = 'Matter Cost in Salary'
+
+PRACTICE_AREAS = ['Corporate', 'Litigation', 'Crypto Law', 'Russian Law', 'Tax',
+                  'Employment', 'Real Estate', 'Internal Projects']
+CURRENCIES = ['USD', 'EUR', 'RUB']
+
+# Share of rows without a Practice Area, the exports have a few of those
+MISSING_PRACTICE_AREA = 0.02
+
+
+# Quarter names ending with Q4 of last_year, oldest first (Q1_2016 ... Q4_2025 for 40)
+def period_names(count, last_year=2025):
+    periods = []
+    year, quarter = last_year, 4
+    for _ in range(count):
+        periods.append(f'Q{quarter}_{year}')
+        year, quarter = (year, quarter - 1) if quarter > 1 else (year - 1, 4)
+    return periods[::-1]
+
+
+def _categorical(rng, categories, rows, missing=0.0):
+    codes = rng.integers(0, len(categories), rows)
+    if missing:
+        codes[rng.random(rows) < missing] = -1
+    return pd.Categorical.from_codes(codes, categories)
+
+
+# MP export of one period: one row per time entry
+def make_mp(rows, users=200, clients=2000, matters=5000, period='Q4_2025', seed=0, salary_column=SALARY_COLUMN):
+    rng = np.random.default_rng(seed)
+    user_names = [f'User {i}' for i in range(users)]
+    user_codes = rng.integers(0, users, rows)
+
+    # Hour totals are per user, every row of a user repeats them
+    primary_hours = rng.integers(100, 500, users).astype('float32')
+    marketing_hours = rng.integers(0, 60, users).astype('float32')
+
+    quarter, year = period.split('_')
+    start = pd.Timestamp(year=int(year), month=3 * int(quarter[1]) - 2, day=1)
+
+    return pd.DataFrame({
+        'User': pd.Categorical.from_codes(user_codes, user_names),
+        'Practice Area': _categorical(rng, PRACTICE_AREAS, rows, MISSING_PRACTICE_AREA),
+        'Matter Number': _categorical(rng, [f'M-{i:06d}' for i in range(matters)], rows),
+        'Client': _categorical(rng, [f'Client {i}' for i in range(clients)], rows),
+        'Date': start + pd.to_timedelta(rng.integers(0, 90, rows), 'D'),
+        'Quantity': (rng.integers(1, 40, rows) / 4).astype('float32'),
+        salary_column: rng.random(rows) * 500,
+        'User Primary Hours': primary_hours[user_codes],
+        'User Marketing Hours': marketing_hours[user_codes],
+        'User Total Hours': (primary_hours + marketing_hours)[user_codes],
+    })
+
+
+# RR export of one period: one row per collected invoice line
+def make_rr(rows, clients=2000, matters=5000, seed=0, revenue_column=REVENUE_COLUMN):
+    rng = np.random.default_rng(seed + 1)
+    collected = rng.random(rows) * 1000
+
+    return pd.DataFrame({
+        'Client': _categorical(rng, [f'Client {i}' for i in range(clients)], rows),
+        'Matter Number': _categorical(rng, [f'M-{i:06d}' for i in range(matters)], rows),
+        'Matter Description': np.full(rows, 'Legal services', dtype=object),
+        'Practice Area': _categorical(rng, PRACTICE_AREAS, rows, MISSING_PRACTICE_AREA),
+        'Currency': _categorical(rng, CURRENCIES, rows),
+        'Collected Time': collected,
+        revenue_column: collected,
+    })
+
+
+# (MP, RR) of one period with mp_rows time entries, RR gets half as many rows as in the real exports
+def make_period(mp_rows, users=200, clients=2000, matters=5000, period='Q4_2025', seed=0):
+    MP = make_mp(mp_rows, users, clients, matters, period, seed)
+    RR = make_rr(max(1, mp_rows // 2), clients, matters, seed)
+    return MP, RR
+
+
+# The unpickled dynamic_data.pkl (what retrieve_pkl_data builds) with `rows` margin table rows in total,
+# spread over `periods` quarters. Above a handful of practice areas the names are synthetic.
+def make_dynamic_payload(rows, periods=40, seed=0):
+    rng = np.random.default_rng(seed)
+    period_list = period_names(periods)
+    areas_per_period = max(1, rows // len(period_list))
+    practice_areas = PRACTICE_AREAS[:areas_per_period] + \
+        [f'Area {i}' for i in range(areas_per_period - len(PRACTICE_AREAS))]
+
+    payload = {}
+    for period in period_list:
+        salary = rng.random(areas_per_period) * 50_000
+        revenue = rng.random(areas_per_period) * 100_000
+        margin_table = pd.DataFrame({
+            'Practice Area': practice_areas,
+            SALARY_COLUMN: salary,
+            REVENUE_COLUMN: revenue,
+            'Margin, %': (revenue - salary) / revenue * 100,
+            'x2 Salary': 2 * salary,
+            'Delta of Revenue and x2 Salary': revenue - 2 * salary,
+        })
+        payload[period] = {
+            'margin_table': margin_table,
+            'total_salaries': salary.sum(),
+            'total_collected_time': revenue.sum(),
+            'sources': {},
+        }
+    return payload
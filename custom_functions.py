@@ -1,20 +1,46 @@
 
 import plotly.graph_objects as go
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from streamlit.runtime.caching.cache_data_api import get_data_cache_stats_provider
 import plotly.express as px
 import plotly.graph_objs as go
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+import pyarrow.fs as pa_fs
 import pickle
 import logging
+import io
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import functools
+import threading
+import json
+import re
+import hashlib
+import uuid
+import time
+import os
+import sys
+import resource
+from pympler import asizeof
+import xlsxwriter
+from st_files_connection import FilesConnection
+from fsspec.implementations.dirfs import DirFileSystem
+from fsspec.implementations.local import LocalFileSystem
+from fsspec.implementations.memory import MemoryFileSystem
 
 #######################################
 # PAGE CONFIGURATION FUNCTIONS
 #######################################
 
-def convert_df_to_csv_bytes(df):
-    return df.to_csv(index=False).encode('utf-8')
-
-
 def authenticate(user_email, allowed_emails):
     if user_email in allowed_emails:
         return True
@@ -22,22 +48,1387 @@ def authenticate(user_email, allowed_emails):
         st.warning('You don\'t have access to this content')
         st.stop()
 
+# Periods of a practice folder that have both exports, oldest first (see period_catalog)
 def create_periods_list(conn, path):
+    catalog = period_catalog(conn, path)
+    periods_list = [period for period, files in catalog.items()
+                    if period_is_complete(period, files)]
+    return sorted(periods_list, key=quarter_sort_key)
+
+
+def quarter_sort_key(p):
+    q, y = p.split("_")
+    return (int(y), int(q[1:]))
+
+#######################################
+# STORAGE
+#######################################
+
+# Every data access goes through conn.fs (an fsspec filesystem laid out like the bucket: clio-reports/<practice>/<period>/...)
+# get_connection picks the backend from the [storage] table of the secrets or from the environment:
+#   backend:        gcs (default) | local | memory      env CLIO_STORAGE_BACKEND
+#   root:           local: directory that holds clio-reports/
+#                   memory: optional directory copied in at start  env CLIO_STORAGE_ROOT
+#   latency_ms:     delay added to every storage request            env CLIO_STORAGE_LATENCY_MS
+#   bandwidth_mbps: read/write throughput limit, MB/s               env CLIO_STORAGE_BANDWIDTH_MBPS
+STORAGE_BACKENDS = ('gcs', 'local', 'memory')
+STORAGE_ENV = {'backend': 'CLIO_STORAGE_BACKEND', 'root': 'CLIO_STORAGE_ROOT',
+               'latency_ms': 'CLIO_STORAGE_LATENCY_MS', 'bandwidth_mbps': 'CLIO_STORAGE_BANDWIDTH_MBPS'}
+
+
+# Anything with an .fs attribute works as conn, this is the one used for the local and in-memory backends
+class StorageConnection:
+    def __init__(self, fs):
+        self.fs = fs
+
+
+# Wraps a filesystem and sleeps before every request (and per byte read or written if a bandwidth is set),
+# so the app can be profiled offline as if the data were remote
+class LatencyFileSystem:
+    DELAYED_METHODS = {'ls', 'info', 'find', 'glob', 'exists', 'isdir', 'isfile', 'open',
+                       'cat_file', 'pipe_file', 'put', 'get', 'rm', 'mv', 'copy'}
+
+    def __init__(self, fs, latency=0.0, bandwidth=None):
+        self.fs = fs
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def __getattr__(self, name):
+        attr = getattr(self.fs, name)
+        if name not in self.DELAYED_METHODS or not callable(attr):
+            return attr
+
+        def delayed(*args, **kwargs):
+            time.sleep(self.latency)
+            result = attr(*args, **kwargs)
+            if name == 'open' and self.bandwidth:
+                return ThrottledFile(result, self.bandwidth)
+            return result
+        return delayed
+
+
+# File object that delegates everything to f, the base of ThrottledFile and CountingFile
+class FileProxy:
+    def __init__(self, f):
+        self.f = f
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def __iter__(self):
+        return iter(self.f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.f.close()
+
+
+# File object of LatencyFileSystem.open that reads and writes at most `bandwidth` bytes per second
+class ThrottledFile(FileProxy):
+    def __init__(self, f, bandwidth):
+        super().__init__(f)
+        self.bandwidth = bandwidth
+
+    def read(self, *args):
+        data = self.f.read(*args)
+        time.sleep(len(data) / self.bandwidth)
+        return data
+
+    def write(self, data):
+        time.sleep(len(data) / self.bandwidth)
+        return self.f.write(data)
+
+
+# Settings of a table of the secrets ([storage], [memory]...), environment variables take precedence
+def secret_settings(section, env_variables):
+    try:
+        settings = dict(st.secrets.get(section, {}))
+    except FileNotFoundError:
+        # No secrets file, e.g. a local run configured from the environment
+        settings = {}
+    for setting, variable in env_variables.items():
+        if os.environ.get(variable):
+            settings[setting] = os.environ[variable]
+    return settings
+
+
+def storage_settings():
+    return secret_settings('storage', STORAGE_ENV)
+
+
+# Connection used by all pages, see STORAGE above for the settings
+def get_connection():
+    settings = storage_settings()
+    backend = settings.get('backend', 'gcs')
+    latency = float(settings.get('latency_ms', 0)) / 1000
+    bandwidth = float(settings.get('bandwidth_mbps', 0)) * 2**20 or None
+
+    if backend == 'gcs' and not latency and not bandwidth:
+        return st.connection('gcs', type=FilesConnection)
+    return storage_connection(backend, settings.get('root'), latency, bandwidth)
+
+
+# One connection per configuration and process: the in-memory backend keeps its contents across reruns
+@st.cache_resource
+def storage_connection(backend, root=None, latency=0.0, bandwidth=None):
+    if backend == 'gcs':
+        fs = st.connection('gcs', type=FilesConnection).fs
+    elif backend == 'local':
+        if not root:
+            raise ValueError('The local storage backend needs a root directory')
+        fs = DirFileSystem(path=root, fs=LocalFileSystem(auto_mkdir=True))
+    elif backend == 'memory':
+        fs = DirFileSystem(path='/clio', fs=MemoryFileSystem())
+        if root:
+            fs.put(f"{root.rstrip('/')}/", '', recursive=True)
+    else:
+        raise ValueError(
+            f"Unknown storage backend {backend!r}, expected one of {', '.join(STORAGE_BACKENDS)}")
+
+    if latency or bandwidth:
+        fs = LatencyFileSystem(fs, latency, bandwidth)
+    logging.info(f"Storage: {backend} backend (root={root}, latency={latency * 1000:.0f}ms, "
+                 f"bandwidth={'unlimited' if not bandwidth else f'{bandwidth / 2**20:.1f}MB/s'})")
+    return StorageConnection(fs)
+
+#######################################
+# INSTRUMENTATION
+#######################################
+
+# Every stage of a page run (listing, reads, aggregations, charts) is timed with timed_stage:
+#   with timed_stage('read', period=period, kind=kind) as record:
+#       ...
+#       record['cache'] = 'hit'  # extra fields: cache hit/miss, bytes, rows...
+# The records are logged as JSON lines on the "clio.timing" logger, kept for the p50/p95 of the
+# diagnostics panel and collected per page run (start_page_run) for the panel's "this run" table
+TIMING_HISTORY = 500
+timing_logger = logging.getLogger('clio.timing')
+_page_run = threading.local()
+
+
+# The last TIMING_HISTORY records of every stage, for the whole process
+class StageTimings:
+    def __init__(self, history=TIMING_HISTORY):
+        self.history = history
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self._records.setdefault(record['stage'], deque(
+                maxlen=self.history)).append(record)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    # count, p50, p95 and max seconds of every stage, with the cache hits/misses and the bytes read
+    def summary(self):
+        with self._lock:
+            records = {stage: list(stage_records)
+                       for stage, stage_records in self._records.items()}
+
+        rows = []
+        for stage, stage_records in sorted(records.items()):
+            seconds = np.array([record['seconds'] for record in stage_records])
+            rows.append({
+                'stage': stage,
+                'count': len(seconds),
+                'p50, s': np.percentile(seconds, 50),
+                'p95, s': np.percentile(seconds, 95),
+                'max, s': seconds.max(),
+                'cache hits': sum(record.get('cache') == 'hit' for record in stage_records),
+                'cache misses': sum(record.get('cache') == 'miss' for record in stage_records),
+                'MB read': sum(record.get('bytes', 0) for record in stage_records) / 2**20,
+            })
+        return pd.DataFrame(rows)
+
+
+@st.cache_resource
+def stage_timings():
+    return StageTimings()
+
+
+@contextmanager
+def timed_stage(stage, **fields):
+    record = {'stage': stage, **fields}
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        stage_timings().add(record)
+        run_records = getattr(_page_run, 'records', None)
+        if run_records is not None:
+            run_records.append(record)
+        timing_logger.info(json.dumps(record, default=str))
+
+
+# Decorator version of timed_stage, the record is named after the function
+def timed(stage):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timed_stage(stage, name=function.__name__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Called at the top of a page, the stages recorded by this script thread from now on belong to the run
+# The first call of the process also starts the RSS monitor
+def start_page_run(page):
+    rss_monitor()
+    _page_run.page = page
+    _page_run.start = time.perf_counter()
+    _page_run.records = []
+
+
+# File object that adds the number of bytes read to record['bytes']
+class CountingFile(FileProxy):
+    def __init__(self, f, record):
+        super().__init__(f)
+        self.record = record
+        record.setdefault('bytes', 0)
+
+    def read(self, *args):
+        data = self.f.read(*args)
+        self.record['bytes'] += len(data)
+        return data
+
+    def read1(self, *args):
+        data = self.f.read1(*args)
+        self.record['bytes'] += len(data)
+        return data
+
+    def readinto(self, buffer):
+        size = self.f.readinto(buffer)
+        self.record['bytes'] += size or 0
+        return size
+
+
+# Management only: timings of this page run and p50/p95 of every stage since the server started,
+# memory of the caches and the session state. objects: large objects of the page to account for (see memory_report)
+def diagnostics_panel(objects=None):
+    if st.experimental_user.email not in st.secrets["management_emails"]:
+        return
+
+    with st.expander("Diagnostics"):
+        records = getattr(_page_run, 'records', None) or []
+        if getattr(_page_run, 'start', None) is not None:
+            st.write(f"**This run** ({getattr(_page_run, 'page', '')}): "
+                     f"{time.perf_counter() - _page_run.start:.2f} s so far")
+        if records:
+            st.dataframe(pd.DataFrame(records), hide_index=True,
+                         use_container_width=True)
+
+        st.write('**All runs of this server process**')
+        st.dataframe(stage_timings().summary(), hide_index=True,
+                     use_container_width=True)
+
+        st.write('**Shared caches**')
+        st.dataframe(pd.DataFrame({'period cache': period_cache().stats(),
+                                   'figure cache': figure_cache().stats()}).T,
+                     use_container_width=True)
+
+        if st.button('Reset timings'):
+            stage_timings().clear()
+
+        st.write(f'**Memory** (process RSS {process_rss() / 2**20:.0f} MB)')
+        st.line_chart(rss_monitor().history())
+        st.dataframe(memory_report(objects), hide_index=True,
+                     use_container_width=True)
+
+#######################################
+# MEMORY ACCOUNTING
+#######################################
+
+# Size ceilings of the shared caches in MB, from the [memory] table of the secrets or the environment
+# (0 turns the ceiling off). Above the ceiling the least recently used entries are evicted.
+MEMORY_DEFAULTS = {'period_cache_mb': 1024, 'figure_cache_mb': 128}
+MEMORY_ENV = {'period_cache_mb': 'CLIO_PERIOD_CACHE_MB',
+              'figure_cache_mb': 'CLIO_FIGURE_CACHE_MB'}
+
+# Process RSS is sampled every RSS_SAMPLE_SECONDS, the last RSS_HISTORY samples are kept (a day)
+RSS_SAMPLE_SECONDS = 30
+RSS_HISTORY = 2880
+
+# Bounds of the st.cache_data caches of the app (their memory is listed in memory_report next to the shared caches)
+DATA_CACHE_ENTRIES = 64
+DATA_CACHE_TTL = 3600
+
+
+def cache_ceiling(setting):
+    megabytes = float(secret_settings('memory', MEMORY_ENV).get(
+        setting, MEMORY_DEFAULTS[setting]))
+    return int(megabytes * 2**20) if megabytes > 0 else None
+
+
+# Bytes held by an object. Frames are measured by pandas (deep), which is exact and fast,
+# containers are walked, everything else (figures, session state values...) is measured by Pympler
+def memory_size(obj):
+    if obj is None:
+        return 0
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(deep=True))
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    if isinstance(obj, (list, tuple)):
+        return sum(memory_size(item) for item in obj)
+    if isinstance(obj, dict):
+        return sum(memory_size(key) + memory_size(value) for key, value in obj.items())
+    return asizeof.asizeof(obj)
+
+
+# Resident memory of the server process in bytes (peak RSS where /proc is not available)
+def process_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Samples process_rss in a background thread
+class RSSMonitor:
+    def __init__(self, interval=RSS_SAMPLE_SECONDS, history=RSS_HISTORY):
+        self.interval = interval
+        self.samples = deque(maxlen=history)
+        self._thread = threading.Thread(
+            target=self._run, name='rss-monitor', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self.samples.append((pd.Timestamp.now(), process_rss()))
+            time.sleep(self.interval)
+
+    def history(self):
+        return pd.DataFrame(list(self.samples), columns=['time', 'rss']).assign(
+            **{'RSS, MB': lambda df: df['rss'] / 2**20}).drop(columns='rss').set_index('time')
+
+
+# Started with the first page run of the process (see start_page_run)
+@st.cache_resource
+def rss_monitor():
+    return RSSMonitor()
+
+
+# Memory of the shared caches by practice and period, of the session state and of page objects
+# objects: {name: object} of the page, a dict of period entries (the dynamic payload) is broken down by period
+def memory_report(objects=None):
+    rows = []
+    for key, value, size in period_cache().items():
+        kind, folder_path, period = key[:3]
+        practice = folder_path.split('/')[-1]
+        if kind.startswith('dynamic'):
+            # (kind, object path, version)
+            rows.append({'owner': 'period cache', 'object': f'{kind} {folder_path}',
+                         'bytes': size})
+        elif kind == 'period':
+            rows.append({'owner': 'period cache', 'object': 'MP', 'practice': practice,
+                         'period': period, 'bytes': memory_size(value[0])})
+            rows.append({'owner': 'period cache', 'object': 'RR', 'practice': practice,
+                         'period': period, 'bytes': memory_size(value[1])})
+        else:
+            rows.append({'owner': 'period cache', 'object': kind, 'practice': practice,
+                         'period': period, 'bytes': memory_size(value)})
+
+    for key, _, size in figure_cache().items():
+        rows.append({'owner': 'figure cache',
+                    'object': key[0], 'bytes': size})
+
+    # st.cache_data keeps pickled values, sizes are summed per cached function
+    for stat in get_data_cache_stats_provider().get_stats():
+        if stat.cache_name.startswith(f'{__name__}.'):
+            rows.append({'owner': 'data cache', 'object': stat.cache_name.split('.')[-1],
+                         'bytes': stat.byte_length})
+
+    for name, value in st.session_state.to_dict().items():
+        rows.append({'owner': 'session state',
+                    'object': name, 'bytes': memory_size(value)})
+
+    for name, obj in (objects or {}).items():
+        if isinstance(obj, dict) and obj and all(PERIOD_PATTERN.match(str(key)) for key in obj):
+            rows += [{'owner': 'page', 'object': name, 'period': period, 'bytes': memory_size(entry)}
+                     for period, entry in obj.items()]
+        else:
+            rows.append({'owner': 'page', 'object': name,
+                        'bytes': memory_size(obj)})
+
+    report = pd.DataFrame(rows, columns=[
+                          'owner', 'object', 'practice', 'period', 'bytes'])
+    report['MB'] = report.pop('bytes') / 2**20
+    return report.sort_values('MB', ascending=False, ignore_index=True)
+
+#######################################
+# PERIOD DATA LOADING
+#######################################
+
+# Every uploaded Clio export (MP/RR csv) gets a Parquet snapshot next to it.
+# The snapshot remembers the version of the csv it was built from, so a re-uploaded csv is picked up again.
+PARQUET_COMPRESSION = 'zstd'
+SOURCE_VERSION_KEY = b'clio_source_version'
+
+
+def period_file_path(folder_path, period, kind, extension='csv'):
+    # kind is 'MP' or 'RR'
+    return f"{folder_path}/{period}/{kind}_{period}.{extension}"
+
+
+# Returns a string that changes every time the object is replaced (generation on GCS, mtime and size locally)
+def info_version(info):
+    for key in ('generation', 'md5Hash', 'etag'):
+        if info.get(key):
+            return f"{key}:{info[key]}"
+    return f"{info.get('mtime', info.get('created'))}:{info.get('size')}"
+
+
+def object_version(fs, path):
+    fs.invalidate_cache(path)
+    return info_version(fs.info(path))
+
+
+# Versions used in cache keys are checked at most every VERSION_CHECK_TTL seconds, not on every rerun
+VERSION_CHECK_TTL = 30
+
+
+# object_version for cache keys. Publishing an object from this process drops these (publish_object)
+@st.cache_data(ttl=VERSION_CHECK_TTL, max_entries=DATA_CACHE_ENTRIES, show_spinner=False)
+def cached_object_version(_conn, path):
+    return object_version(_conn.fs, path)
+
+
+# Versions of the MP/RR csv exports of a period (None if the file is missing), one listing per period
+def period_source_versions(conn, folder_path, period):
     fs = conn.fs
-    period_folders_list = fs.ls(path)[1:]
-    # st.write(period_folders_list) debug line
+    period_folder = f"{folder_path}/{period}"
+    fs.invalidate_cache(period_folder)
+    with timed_stage('versions', folder=folder_path, period=period):
+        files = {info['name'].split('/')[-1]: info
+                 for info in fs.ls(period_folder, detail=True)}
+
+    versions = {}
+    for kind in ('MP', 'RR'):
+        info = files.get(period_file_path(folder_path, period, kind).split('/')[-1])
+        versions[kind] = info_version(info) if info else None
+    return versions
+
+
+# Loading schema of the exports: dimension columns are stored as categoricals (dictionary encoded in Parquet)
+# and other measures are narrowed where no value changes (ints to the smallest int type, floats to float32).
+# Money columns are always float64: sums of float32 amounts lose whole units even when every amount is whole
+CATEGORY_COLUMNS = ['User', 'Practice Area', 'Client', 'Matter Number', 'Currency']
+MONEY_COLUMNS = ['Collected Time', 'USD Collected Time', 'RUB Collected Time',
+                 'Matter Cost in Salary', 'RUB Matter Cost in Salary']
+
+
+def apply_period_schema(df):
+    df = df.copy()
+    for column in df.columns:
+        values = df[column]
+        if column in CATEGORY_COLUMNS:
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                df[column] = values.astype('category')
+        elif column in MONEY_COLUMNS:
+            # Also widens snapshots written while money columns were narrowed
+            if pd.api.types.is_numeric_dtype(values.dtype) and values.dtype != 'float64':
+                df[column] = values.astype('float64')
+        elif pd.api.types.is_integer_dtype(values.dtype):
+            df[column] = pd.to_numeric(values, downcast='integer')
+        elif pd.api.types.is_float_dtype(values.dtype) and values.dtype != 'float32':
+            narrowed = values.astype('float32')
+            if narrowed.astype(values.dtype).equals(values):
+                df[column] = narrowed
+    return df
+
+
+# Memory of every column before and after apply_period_schema, in bytes
+def schema_memory_report(df):
+    typed = apply_period_schema(df)
+    report = pd.DataFrame({
+        'dtype before': df.dtypes.astype(str),
+        'dtype after': typed.dtypes.astype(str),
+        'bytes before': df.memory_usage(index=False, deep=True),
+        'bytes after': typed.memory_usage(index=False, deep=True),
+    })
+    report.loc['Total'] = ['', '', report['bytes before'].sum(),
+                           report['bytes after'].sum()]
+    report['saved, %'] = (1 - report['bytes after'] /
+                          report['bytes before']) * 100
+    return report
 
-    periods_list = []
 
-    for folder in period_folders_list:
-        periods_list.append(folder.split('/')[2])
+def write_parquet_snapshot(fs, df, parquet_path, source_version):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[SOURCE_VERSION_KEY] = source_version.encode('utf-8')
+    table = table.replace_schema_metadata(metadata)
+    with fs.open(parquet_path, 'wb') as f:
+        pq.write_table(table, f, compression=PARQUET_COMPRESSION)
 
-    return periods_list
 
+# Ingest step: parses the csv once and stores it as a Parquet snapshot
+# A failed write (e.g. read-only credentials) is only logged, the parsed data is still returned
+def ingest_period_file(conn, folder_path, period, kind):
+    fs = conn.fs
+    csv_path = period_file_path(folder_path, period, kind)
+    source_version = object_version(fs, csv_path)
+    with timed_stage('ingest', folder=folder_path, period=period, kind=kind) as record:
+        with CountingFile(fs.open(csv_path, 'rb'), record) as f:
+            df = apply_period_schema(pd.read_csv(f))
+        record['rows'] = len(df)
+
+    try:
+        write_parquet_snapshot(fs, df, period_file_path(
+            folder_path, period, kind, 'parquet'), source_version)
+    except Exception as e:
+        logging.error(f"Error writing Parquet snapshot for {csv_path}: {e}")
+
+    if dataset_enabled():
+        try:
+            write_dataset_partition(
+                fs, df, folder_path.split('/')[-1], period, kind, source_version)
+        except Exception as e:
+            logging.error(
+                f"Error writing dataset partition for {csv_path}: {e}")
 
-def quarter_sort_key(p):
-    q, y = p.split("_")
-    return (int(y), int(q[1:]))
+    return df
+
+
+def _current_source_version(fs, folder_path, period, kind):
+    try:
+        return object_version(fs, period_file_path(folder_path, period, kind))
+    except FileNotFoundError:
+        return None  # Only the snapshot is left, use it as is
+
+
+def _snapshot_is_current(parquet_file, source_version):
+    metadata = parquet_file.schema_arrow.metadata or {}
+    snapshot_version = metadata.get(SOURCE_VERSION_KEY, b'').decode('utf-8')
+    return source_version is None or snapshot_version == source_version
+
+
+# Reads the Parquet snapshot of an export, the csv is only parsed when the snapshot is missing or stale
+def read_period_file(conn, folder_path, period, kind):
+    fs = conn.fs
+    source_version = _current_source_version(fs, folder_path, period, kind)
+
+    try:
+        with timed_stage('read', folder=folder_path, period=period, kind=kind, format='parquet') as record:
+            with CountingFile(fs.open(period_file_path(folder_path, period, kind, 'parquet'), 'rb'), record) as f:
+                parquet_file = pq.ParquetFile(f)
+                if _snapshot_is_current(parquet_file, source_version):
+                    # Snapshots written before the loading schema was introduced are typed on the fly
+                    df = apply_period_schema(parquet_file.read().to_pandas())
+                    record['rows'] = len(df)
+                    return df
+                record['stale'] = True
+    except FileNotFoundError:
+        pass
+
+    return ingest_period_file(conn, folder_path, period, kind)
+
+
+# Streaming reads keep at most this many rows of an export in memory
+STREAM_CHUNK_ROWS = 200_000
+
+
+# Ingest step of the streaming reads: the csv becomes its Parquet snapshot (and dataset partition, if enabled)
+# chunk_rows rows at a time, through a temporary file, so memory stays bounded like the reads.
+# Chunks are written with the types of the dataset (_dataset_table), cast to the schema of the first chunk.
+# Returns False without writing anything if a chunk doesn't fit it (e.g. a column that is empty in the first
+# chunk and has text later) or the snapshot can't be written
+def ingest_period_file_streaming(conn, folder_path, period, kind, chunk_rows=STREAM_CHUNK_ROWS):
+    fs = conn.fs
+    csv_path = period_file_path(folder_path, period, kind)
+    source_version = object_version(fs, csv_path)
+
+    with tempfile.TemporaryFile() as snapshot:
+        writer = None
+        try:
+            with timed_stage('ingest', folder=folder_path, period=period, kind=kind, streaming=True) as record:
+                record['rows'] = 0
+                with CountingFile(fs.open(csv_path, 'rb'), record) as f:
+                    for chunk in pd.read_csv(f, chunksize=chunk_rows):
+                        table = _dataset_table(apply_period_schema(chunk))
+                        if writer is None:
+                            schema = table.schema.remove_metadata().with_metadata(
+                                {SOURCE_VERSION_KEY: source_version.encode('utf-8')})
+                            writer = pq.ParquetWriter(
+                                snapshot, schema, compression=PARQUET_COMPRESSION)
+                        writer.write_table(table.cast(schema))
+                        record['rows'] += len(chunk)
+        except pa.ArrowException as e:
+            logging.error(f"Error writing Parquet snapshot for {csv_path} in chunks: {e}")
+            return False
+        finally:
+            if writer is not None:
+                writer.close()
+
+        targets = [period_file_path(folder_path, period, kind, 'parquet')]
+        if dataset_enabled():
+            targets.append(dataset_partition_path(
+                folder_path.split('/')[-1], period, kind))
+        for target in targets:
+            snapshot.seek(0)
+            try:
+                with fs.open(target, 'wb') as f:
+                    shutil.copyfileobj(snapshot, f)
+            except Exception as e:
+                logging.error(f"Error writing {target}: {e}")
+                if target == targets[0]:
+                    return False
+            fs.invalidate_cache(target)
+    return True
+
+
+# The opened snapshot of an export and its ParquetFile, None if it is missing or older than the csv
+def _open_current_snapshot(open_file, parquet_path, source_version):
+    try:
+        f = open_file(parquet_path)
+    except FileNotFoundError:
+        return None
+
+    parquet_file = pq.ParquetFile(f)
+    if not _snapshot_is_current(parquet_file, source_version):
+        f.close()
+        return None
+    return f, parquet_file
+
+
+# Yields an export in chunks of chunk_rows rows with only the given columns, so memory doesn't grow with the file
+# Reads the Parquet snapshot. A missing or stale snapshot is written first (ingest_period_file_streaming),
+# the csv is only streamed if that fails
+# The bytes read are added to record['bytes'] if a timed_stage record is given
+def iter_period_file(conn, folder_path, period, kind, columns, chunk_rows=STREAM_CHUNK_ROWS, record=None):
+    fs = conn.fs
+    source_version = _current_source_version(fs, folder_path, period, kind)
+    parquet_path = period_file_path(folder_path, period, kind, 'parquet')
+
+    def open_file(path):
+        f = fs.open(path, 'rb')
+        return f if record is None else CountingFile(f, record)
+
+    snapshot = _open_current_snapshot(open_file, parquet_path, source_version)
+    if snapshot is None and source_version is not None and \
+            ingest_period_file_streaming(conn, folder_path, period, kind, chunk_rows):
+        snapshot = _open_current_snapshot(open_file, parquet_path, source_version)
+
+    if snapshot is not None:
+        parquet_f, parquet_file = snapshot
+        with parquet_f:
+            present_columns = [
+                column for column in columns if column in parquet_file.schema_arrow.names]
+            for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=present_columns):
+                chunk = batch.to_pandas()
+                # Snapshots written while money columns were narrowed
+                money = [column for column in chunk.columns
+                         if column in MONEY_COLUMNS and chunk[column].dtype != 'float64']
+                yield chunk.astype({column: 'float64' for column in money}) if money else chunk
+        return
+
+    with open_file(period_file_path(folder_path, period, kind)) as f:
+        for chunk in pd.read_csv(f, usecols=lambda column: column in columns, chunksize=chunk_rows):
+            yield chunk
+
+#######################################
+# PERIOD CATALOG
+#######################################
+
+# The list of periods is cached, new uploads are picked up after the TTL or after refresh_period_catalog
+PERIOD_CATALOG_TTL = 600
+PERIOD_MANIFEST_NAME = 'manifest.json'
+PERIOD_PATTERN = re.compile(r'^Q[1-4]_\d{4}$')
+
+
+# Lists a practice folder with a single recursive listing
+# Returns {period: {file name: {'size': bytes, 'version': object version}}}
+def list_period_catalog(conn, folder_path):
+    fs = conn.fs
+    fs.invalidate_cache(folder_path)
+    catalog = {}
+
+    with timed_stage('catalog.list', folder=folder_path) as record:
+        listing = fs.find(folder_path, withdirs=True, detail=True)
+        record['entries'] = len(listing)
+
+    for path, info in listing.items():
+        parts = path.rstrip('/').split('/')
+        if len(parts) < 2:
+            continue
+        if info.get('type') == 'directory' and PERIOD_PATTERN.match(parts[-1]):
+            catalog.setdefault(parts[-1], {})
+        elif info.get('type') != 'directory' and PERIOD_PATTERN.match(parts[-2]):
+            catalog.setdefault(parts[-2], {})[parts[-1]] = {
+                'size': info.get('size'), 'version': info_version(info)}
+
+    return dict(sorted(catalog.items(), key=lambda item: quarter_sort_key(item[0])))
+
+
+# Refreshes of the period catalogs, shared by the sessions of the server process.
+# A folder is listed again at most once per PERIOD_CATALOG_TTL (unless forced), every refresh moves
+# the folder to a new generation, so only its cached catalog is reloaded.
+# The listing of the last refresh is served for PERIOD_CATALOG_TTL, so it wins over an older manifest
+class CatalogRefreshes:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._refreshed = {}
+        self._generations = {}
+        self._listings = {}
+
+    def generation(self, folder_path):
+        return self._generations.get(folder_path, 0)
+
+    # True if the caller should refresh the folder now
+    def start(self, folder_path, force=False):
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._refreshed.get(folder_path, -PERIOD_CATALOG_TTL) < PERIOD_CATALOG_TTL:
+                return False
+            self._refreshed[folder_path] = now
+            return True
+
+    def finish(self, folder_path, catalog=None):
+        with self._lock:
+            self._generations[folder_path] = self.generation(folder_path) + 1
+            if catalog is not None:
+                self._listings[folder_path] = (time.monotonic(), catalog)
+
+    # Catalog listed by the last refresh, None if there was none in the last PERIOD_CATALOG_TTL
+    def listing(self, folder_path):
+        with self._lock:
+            listed = self._listings.get(folder_path)
+        if listed is None or time.monotonic() - listed[0] >= PERIOD_CATALOG_TTL:
+            return None
+        return listed[1]
+
+
+@st.cache_resource
+def catalog_refreshes():
+    return CatalogRefreshes()
+
+
+# Period catalog of a practice folder, cached for PERIOD_CATALOG_TTL seconds or until refresh_period_catalog
+def period_catalog(conn, folder_path):
+    refreshes = catalog_refreshes()
+    listing = refreshes.listing(folder_path)
+    if listing is not None:
+        return listing
+    return _period_catalog(conn, folder_path, refreshes.generation(folder_path))
+
+
+# A manifest object in the folder, if there is one, replaces the bucket listing with a single small GET
+@st.cache_data(ttl=PERIOD_CATALOG_TTL, max_entries=DATA_CACHE_ENTRIES, show_spinner=False)
+def _period_catalog(_conn, folder_path, generation):
+    try:
+        with timed_stage('catalog.manifest', folder=folder_path):
+            with _conn.fs.open(f"{folder_path}/{PERIOD_MANIFEST_NAME}", 'rb') as f:
+                return json.load(f)['periods']
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.error(f"Error reading period manifest of {folder_path}: {e}")
+
+    return list_period_catalog(_conn, folder_path)
+
+
+def period_is_complete(period, files):
+    return all(any(period_file_path('', period, kind, extension).split('/')[-1] in files
+                   for extension in ('csv', 'parquet'))
+               for kind in ('MP', 'RR'))
+
+
+# Writes the manifest of a practice folder from a fresh listing
+def write_period_manifest(conn, folder_path, catalog=None):
+    if catalog is None:
+        catalog = list_period_catalog(conn, folder_path)
+    with conn.fs.open(f"{folder_path}/{PERIOD_MANIFEST_NAME}", 'wb') as f:
+        f.write(json.dumps({'periods': catalog}, indent=1).encode('utf-8'))
+
+
+# Lists the folder and drops its cached catalog, the listing is served until the next refresh or the TTL.
+# Only background jobs pass write_manifest: the manifest is then created, or rewritten if it is out of date.
+# Page runs never write to the bucket.
+# Does nothing (returns None) if the folder was refreshed less than PERIOD_CATALOG_TTL ago, unless force is set
+def refresh_period_catalog(conn, folder_path, force=False, write_manifest=False):
+    refreshes = catalog_refreshes()
+    if not refreshes.start(folder_path, force):
+        return None
+
+    catalog = None
+    try:
+        catalog = list_period_catalog(conn, folder_path)
+        if write_manifest:
+            try:
+                with conn.fs.open(f"{folder_path}/{PERIOD_MANIFEST_NAME}", 'rb') as f:
+                    manifest_catalog = json.load(f)['periods']
+            except FileNotFoundError:
+                manifest_catalog = None
+            except Exception as e:
+                logging.error(f"Error reading period manifest of {folder_path}: {e}")
+                manifest_catalog = None
+
+            # A folder without periods doesn't get a manifest, an existing one is still updated
+            if manifest_catalog != catalog and (catalog or manifest_catalog is not None):
+                try:
+                    write_period_manifest(conn, folder_path, catalog)
+                except Exception as e:
+                    logging.error(f"Error writing period manifest of {folder_path}: {e}")
+    finally:
+        refreshes.finish(folder_path, catalog)
+    return catalog
+
+
+#######################################
+# SHARED PERIOD CACHE
+#######################################
+
+BUCKET_ROOT = 'clio-reports'
+
+# Practice folders in the bucket and the columns their reports are built on
+PRACTICES = {
+    'management': {'revenue_column': 'USD Collected Time', 'salary_column': 'Matter Cost in Salary', 'currency_label': ' USD'},
+    'us_general': {'revenue_column': 'USD Collected Time', 'salary_column': 'Matter Cost in Salary', 'currency_label': ' USD'},
+    'russian_law': {'revenue_column': 'RUB Collected Time', 'salary_column': 'RUB Matter Cost in Salary', 'currency_label': ' RUB'},
+    'crypto_law': {'revenue_column': 'USD Collected Time', 'salary_column': 'Matter Cost in Salary', 'currency_label': ' USD'},
+    'litigation': {'revenue_column': 'USD Collected Time', 'salary_column': 'Matter Cost in Salary', 'currency_label': ' USD'},
+}
+
+PERIOD_CACHE_ENTRIES = 32
+
+
+def practice_folder(practice):
+    return f"{BUCKET_ROOT}/{practice}"
+
+
+# Thread-safe mapping that evicts the least recently used entries and counts hits and misses
+# Concurrent requests for a key that is being computed wait for that computation instead of repeating it
+# With max_bytes, entries are also evicted while their total size (memory_size) is above it; the newest entry is always kept
+class LRUCache:
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            pending = self._pending.get(key)
+            if pending is None:
+                self.misses += 1
+                self._pending[key] = Future()
+            else:
+                self.hits += 1
+
+        if pending is not None:
+            return pending.result()
+
+        # Computed outside the lock, so a slow load doesn't block other sessions
+        try:
+            value = compute()
+            size = memory_size(value)
+        except BaseException as e:
+            with self._lock:
+                self._pending.pop(key).set_exception(e)
+            raise
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._sizes[key] = size
+            self.bytes += size
+            while len(self._entries) > 1 and (len(self._entries) > self.max_entries or
+                                              (self.max_bytes is not None and self.bytes > self.max_bytes)):
+                evicted, _ = self._entries.popitem(last=False)
+                self.bytes -= self._sizes.pop(evicted)
+                self.evictions += 1
+            self._pending.pop(key).set_result(value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.bytes = 0
+
+    # [(key, value, bytes)], least recently used first
+    def items(self):
+        with self._lock:
+            return [(key, value, self._sizes[key]) for key, value in self._entries.items()]
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'MB': self.bytes / 2**20,
+                    'max MB': None if self.max_bytes is None else self.max_bytes / 2**20}
+
+
+# One cache for the whole server process, shared by every page and session
+@st.cache_resource
+def period_cache():
+    return LRUCache(PERIOD_CACHE_ENTRIES, cache_ceiling('period_cache_mb'))
+
+
+def _period_key(conn, folder_path, period):
+    sources = cached_period_source_versions(conn, folder_path, period)
+    return (folder_path, period, sources['MP'], sources['RR'])
+
+
+# period_source_versions for cache keys, so reruns and Data Viewer interactions don't list the period folder.
+# A re-upload is picked up after VERSION_CHECK_TTL seconds or when refresh_period_catalog runs for the folder
+def cached_period_source_versions(conn, folder_path, period):
+    return _cached_period_source_versions(conn, folder_path, period, catalog_refreshes().generation(folder_path))
+
+
+@st.cache_data(ttl=VERSION_CHECK_TTL, max_entries=DATA_CACHE_ENTRIES, show_spinner=False)
+def _cached_period_source_versions(_conn, folder_path, period, generation):
+    return period_source_versions(_conn, folder_path, period)
+
+
+# Returns (MP, RR) of a practice period.
+# The cache key contains the versions of the exports, so the data stays cached until a file is re-uploaded
+# and a new upload is picked up within VERSION_CHECK_TTL seconds. The frames are shared, treat them as read-only.
+def load_period(conn, practice, period):
+    folder_path = practice_folder(practice)
+    key = _period_key(conn, folder_path, period)
+
+    with timed_stage('load_period', practice=practice, period=period, cache='hit') as record:
+        def read_period():
+            record['cache'] = 'miss'
+            MP = read_period_file(conn, folder_path, period, 'MP')
+            RR = read_period_file(conn, folder_path, period, 'RR')
+            return MP, RR
+
+        return period_cache().get_or_compute(('period',) + key, read_period)
+
+
+# Returns the aggregate cube of a practice period, cached like load_period
+# The cube is built by streaming the exports, so the full frames are never loaded for it
+def load_period_cube(conn, practice, period):
+    folder_path = practice_folder(practice)
+    key = _period_key(conn, folder_path, period)
+
+    with timed_stage('load_period_cube', practice=practice, period=period, cache='hit') as record:
+        def build_cube():
+            record['cache'] = 'miss'
+            return build_period_cube_streaming(conn, folder_path, period, PRACTICES[practice]['revenue_column'],
+                                               PRACTICES[practice]['salary_column'])
+
+        return period_cache().get_or_compute(('cube',) + key, build_cube)
+
+
+# Worker threads of a page run get the script run context of that run.
+# The st.cache_* functions they call (period_catalog, the shared caches) log a "missing ScriptRunContext" warning otherwise
+def _attach_script_run_ctx(ctx):
+    add_script_run_ctx(threading.current_thread(), ctx)
+
+
+# Background threads (pre-warm, refresh jobs and their pools) outlive the session that starts them,
+# so they run without a context. Their names start with BACKGROUND_THREAD_PREFIX and the warning is dropped for them
+BACKGROUND_THREAD_PREFIX = 'clio-background'
+
+
+class BackgroundThreadFilter(logging.Filter):
+    def filter(self, record):
+        return not (threading.current_thread().name.startswith(BACKGROUND_THREAD_PREFIX)
+                    and 'missing ScriptRunContext' in record.getMessage())
+
+
+_script_run_ctx_logger = logging.getLogger('streamlit.runtime.scriptrunner.script_run_context')
+# The module is executed again when the app reloads it
+if not any(type(f).__name__ == 'BackgroundThreadFilter' for f in _script_run_ctx_logger.filters):
+    _script_run_ctx_logger.addFilter(BackgroundThreadFilter())
+
+
+# ThreadPoolExecutor arguments that attach the current script run context to the workers.
+# Pools started by background threads are background threads themselves
+def script_run_ctx_initializer():
+    ctx = get_script_run_ctx(suppress_warning=True)
+    if ctx is None:
+        return {'thread_name_prefix': f'{BACKGROUND_THREAD_PREFIX}-pool'}
+    return {'initializer': _attach_script_run_ctx, 'initargs': (ctx,)}
+
+
+PREWARM_PERIODS = 1
+PREWARM_MAX_WORKERS = 2
+
+
+# Loads the cubes of the latest period(s) of every practice into the shared cache,
+# so the first page view after a restart doesn't wait for the listing, the downloads and the aggregation
+def prewarm_period_cache(conn, periods_per_practice=PREWARM_PERIODS, max_workers=PREWARM_MAX_WORKERS):
+    jobs = []
+    for practice in PRACTICES:
+        try:
+            periods = create_periods_list(conn, practice_folder(practice))
+        except Exception as e:
+            logging.error(f"Pre-warm: listing {practice} failed: {e}")
+            continue
+        jobs += [(practice, period) for period in periods[-periods_per_practice:]]
+
+    logging.info(f"Pre-warm: loading {len(jobs)} period(s)")
+    start = time.perf_counter()
+
+    def warm(job):
+        practice, period = job
+        job_start = time.perf_counter()
+        load_period_cube(conn, practice, period)
+        return time.perf_counter() - job_start
+
+    # A small pool, so pre-warming doesn't starve the sessions that are already open
+    with ThreadPoolExecutor(max_workers=max_workers, **script_run_ctx_initializer()) as executor:
+        futures = {executor.submit(warm, job): job for job in jobs}
+        for done, future in enumerate(as_completed(futures), start=1):
+            practice, period = futures[future]
+            try:
+                logging.info(
+                    f"Pre-warm {done}/{len(jobs)}: {practice} {period} ({future.result():.1f}s)")
+            except Exception as e:
+                logging.error(
+                    f"Pre-warm {done}/{len(jobs)}: {practice} {period} failed: {e}")
+
+    logging.info(f"Pre-warm finished in {time.perf_counter() - start:.1f}s")
+
+
+# Starts prewarm_period_cache in a background thread, once per server process
+# Called at the top of the pages, the first visitor doesn't wait for it
+@st.cache_resource
+def start_prewarm(_conn):
+    thread = threading.Thread(target=prewarm_period_cache, args=(_conn,),
+                              name=f'{BACKGROUND_THREAD_PREFIX}-prewarm', daemon=True)
+    thread.start()
+    return thread
+
+#######################################
+# PARTITIONED DATASET
+#######################################
+
+# Optional copy of the exports as one hive-partitioned Parquet dataset per export kind:
+#   clio-reports/dataset/MP/practice=<practice>/year=<YYYY>/quarter=<n>/part-0.parquet
+# Written on ingest when enabled ([dataset] enabled = true in the secrets or CLIO_DATASET=1),
+# write_practice_dataset backfills the periods that were ingested before (start_dataset_backfill_job).
+# load_dataset reads only the partitions and columns a multi-period view asks for, the dynamic build
+# reads the periods it recomputes from it (dataset_period_cubes).
+# Like the snapshots, every partition remembers the version of the csv it was written from.
+DATASET_ROOT = f"{BUCKET_ROOT}/dataset"
+DATASET_ENV = {'enabled': 'CLIO_DATASET'}
+DATASET_PARTITIONING = ds.partitioning(
+    pa.schema([('practice', pa.string()), ('year', pa.int32()), ('quarter', pa.int32())]), flavor='hive')
+
+
+def dataset_enabled():
+    return str(secret_settings('dataset', DATASET_ENV).get('enabled', '')).lower() in ('1', 'true', 'yes')
+
+
+def dataset_partition_path(practice, period, kind):
+    quarter, year = period.split('_')
+    return f"{DATASET_ROOT}/{kind}/practice={practice}/year={year}/quarter={quarter[1:]}/part-0.parquet"
+
+
+# Partitions are written with one type per kind of column (categoricals as int32 dictionaries of strings,
+# int64, float64), so partitions narrowed differently by apply_period_schema still share a schema
+def _dataset_table(df):
+    df = df.copy()
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype) and df[column].cat.categories.dtype != object:
+            df[column] = df[column].cat.rename_categories(str)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    fields = []
+    for field in table.schema:
+        if pa.types.is_dictionary(field.type):
+            fields.append(field.with_type(
+                pa.dictionary(pa.int32(), pa.string())))
+        elif pa.types.is_integer(field.type):
+            fields.append(field.with_type(pa.int64()))
+        elif pa.types.is_floating(field.type):
+            fields.append(field.with_type(pa.float64()))
+        else:
+            fields.append(field)
+    return table.cast(pa.schema(fields))
+
+
+def write_dataset_partition(fs, df, practice, period, kind, source_version):
+    table = _dataset_table(df)
+    metadata = dict(table.schema.metadata or {})
+    metadata[SOURCE_VERSION_KEY] = source_version.encode('utf-8')
+    with fs.open(dataset_partition_path(practice, period, kind), 'wb') as f:
+        pq.write_table(table.replace_schema_metadata(metadata), f,
+                       compression=PARQUET_COMPRESSION)
+
+
+# True if the partition exists and was written from the given version of the csv (only its footer is read)
+def dataset_partition_is_current(fs, practice, period, kind, source_version):
+    if source_version is None:
+        return False
+    try:
+        with fs.open(dataset_partition_path(practice, period, kind), 'rb') as f:
+            metadata = pq.read_schema(f).metadata or {}
+    except FileNotFoundError:
+        return False
+    return metadata.get(SOURCE_VERSION_KEY, b'').decode('utf-8') == source_version
+
+
+# Writes the partitions of every complete period of a practice from its snapshots (or csv)
+# Partitions that are already current are skipped, so an interrupted backfill can simply be started again.
+# Returns the number of partitions written
+def write_practice_dataset(conn, practice, progress=None):
+    folder_path = practice_folder(practice)
+    periods_list = create_periods_list(conn, folder_path)
+    written = 0
+    for done, period in enumerate(periods_list, start=1):
+        sources = period_source_versions(conn, folder_path, period)
+        for kind in ('MP', 'RR'):
+            if sources[kind] is None or dataset_partition_is_current(conn.fs, practice, period, kind, sources[kind]):
+                continue
+            write_dataset_partition(conn.fs, read_period_file(conn, folder_path, period, kind),
+                                    practice, period, kind, sources[kind])
+            written += 1
+            logging.info(f"Dataset: wrote {kind} {practice} {period}")
+        if progress is not None:
+            progress(done, len(periods_list))
+    return written
+
+
+# Filter on the partition columns: practices, an inclusive period range (either end may be None)
+# and a list of periods
+def dataset_filter(practices=None, first_period=None, last_period=None, periods=None):
+    expression = None
+
+    def add(condition):
+        nonlocal expression
+        expression = condition if expression is None else expression & condition
+
+    if practices is not None:
+        add(ds.field('practice').isin(list(practices)))
+    period_index = ds.field('year') * 4 + ds.field('quarter')
+    if first_period is not None:
+        year, quarter = quarter_sort_key(first_period)
+        add(period_index >= year * 4 + quarter)
+    if last_period is not None:
+        year, quarter = quarter_sort_key(last_period)
+        add(period_index <= year * 4 + quarter)
+    if periods is not None:
+        add(period_index.isin([year * 4 + quarter for year, quarter in map(quarter_sort_key, periods)]))
+    return expression
+
+
+# Rows of an export kind ('MP' or 'RR') for the given practices and period range, with only the given columns.
+# Partitions outside the filter are pruned from their paths and never opened, columns are read selectively.
+# The result has the loading schema plus practice and Period ('Q4_2025') columns
+def load_dataset(conn, kind, practices=None, first_period=None, last_period=None, columns=None, periods=None):
+    with timed_stage('dataset', kind=kind, practices=practices, first_period=first_period,
+                     last_period=last_period) as record:
+        filesystem = pa_fs.PyFileSystem(pa_fs.FSSpecHandler(conn.fs))
+        dataset = ds.dataset(f"{DATASET_ROOT}/{kind}", format='parquet', filesystem=filesystem,
+                             partitioning=DATASET_PARTITIONING)
+        expression = dataset_filter(
+            practices, first_period, last_period, periods)
+        fragments = list(dataset.get_fragments(filter=expression))
+        record['partitions'] = len(fragments)
+
+        # Columns can differ between exports, the schema covers every selected partition
+        schema = pa.unify_schemas(
+            [fragment.physical_schema for fragment in fragments] + [DATASET_PARTITIONING.schema])
+        dataset = ds.FileSystemDataset(fragments, schema, ds.ParquetFileFormat(), filesystem)
+
+        if columns is not None:
+            columns = [column for column in columns if column in schema.names and
+                       column not in DATASET_PARTITIONING.schema.names] + DATASET_PARTITIONING.schema.names
+        table = dataset.to_table(columns=columns)
+        record['rows'] = table.num_rows
+
+    df = table.to_pandas()
+    df['Period'] = 'Q' + df.pop('quarter').astype(str) + \
+        '_' + df.pop('year').astype(str)
+    return apply_period_schema(df)
+
+#######################################
+# PERIOD AGGREGATES
+#######################################
+
+USER_HOURS_COLUMNS = ['User Primary Hours',
+                      'User Marketing Hours', 'User Total Hours']
+
+
+def _revenue_by_client(RR, revenue_column):
+    return RR.groupby(['Practice Area', 'Client'], dropna=False, observed=True)[revenue_column].sum()
+
+
+def _salary_by_user(MP, salary_column):
+    return MP.groupby(['Practice Area', 'User'], dropna=False, observed=True)[[salary_column, 'Quantity']].sum()
+
+
+def _user_hours(MP):
+    if not all(column in MP.columns for column in USER_HOURS_COLUMNS):
+        return None
+    return MP.groupby('User', observed=True)[USER_HOURS_COLUMNS].first()
+
+
+# Aggregates a period once, so the dashboard works on a few hundred rows instead of every time entry
+# revenue:    revenue by (Practice Area, Client)               -> create_margin_table, client_contribution
+# salary:     salary and hours (Quantity) by (Practice Area, User) -> create_margin_table, hours_by_practice
+# user_hours: hour totals of every user from MP (None if the export has no such columns) -> display_user_hours_table
+def build_period_cube(MP, RR, revenue_column, salary_column):
+    cube = {}
+    cube['revenue'] = _revenue_by_client(RR, revenue_column).reset_index()
+    cube['salary'] = _salary_by_user(MP, salary_column).reset_index()
+
+    user_hours = _user_hours(MP)
+    cube['user_hours'] = None if user_hours is None else user_hours.reset_index()
+
+    return cube
+
+
+# Rows of an export without rows: the columns with their loading types
+def _empty_export(columns):
+    return pd.DataFrame({column: pd.Series(dtype='category' if column in CATEGORY_COLUMNS else 'float64')
+                         for column in columns})
+
+
+# Same cube as build_period_cube, built from chunks of the exports.
+# Every chunk is aggregated and folded into the running totals, so peak memory is bounded by
+# the chunk size and the number of distinct (Practice Area, Client/User) pairs, not by the file size
+def build_period_cube_streaming(conn, folder_path, period, revenue_column, salary_column, chunk_rows=STREAM_CHUNK_ROWS):
+    revenue = None
+    with timed_stage('aggregate', folder=folder_path, period=period, kind='RR') as record:
+        for chunk in iter_period_file(conn, folder_path, period, 'RR',
+                                      ['Practice Area', 'Client', revenue_column], chunk_rows, record):
+            part = _revenue_by_client(chunk, revenue_column)
+            revenue = part if revenue is None else pd.concat([revenue, part]).groupby(
+                level=[0, 1], dropna=False, observed=True).sum()
+
+    salary = None
+    user_hours = None
+    with timed_stage('aggregate', folder=folder_path, period=period, kind='MP') as record:
+        for chunk in iter_period_file(conn, folder_path, period, 'MP',
+                                      ['Practice Area', 'User', salary_column, 'Quantity'] + USER_HOURS_COLUMNS,
+                                      chunk_rows, record):
+            part = _salary_by_user(chunk, salary_column)
+            salary = part if salary is None else pd.concat([salary, part]).groupby(
+                level=[0, 1], dropna=False, observed=True).sum()
+
+            # 'first' across chunks keeps the value of the earliest chunk
+            part = _user_hours(chunk)
+            if part is not None:
+                user_hours = part if user_hours is None else pd.concat(
+                    [user_hours, part]).groupby(level=0, observed=True).first()
+
+    # An export without rows yields no chunk, its aggregates are empty
+    if revenue is None:
+        revenue = _revenue_by_client(_empty_export(
+            ['Practice Area', 'Client', revenue_column]), revenue_column)
+    if salary is None:
+        salary = _salary_by_user(_empty_export(
+            ['Practice Area', 'User', salary_column, 'Quantity']), salary_column)
+
+    cube = {}
+    cube['revenue'] = revenue.reset_index()
+    cube['salary'] = salary.reset_index()
+    cube['user_hours'] = None if user_hours is None else user_hours.reset_index()
+    return cube
+
+#######################################
+# ATOMIC PUBLISH
+#######################################
+
+# expected_version of publish_object that skips the check
+ANY_VERSION = object()
+_publish_lock = threading.Lock()
+
+
+class PublishConflict(Exception):
+    pass
+
+
+# Version of an object (see info_version), None if it doesn't exist
+def current_object_version(fs, path):
+    try:
+        return object_version(fs, path)
+    except FileNotFoundError:
+        return None
+
+
+# Replaces the object at path with data without readers ever seeing a partial object:
+# the data is written to a temporary object next to it and then moved into place in one step.
+# The move only happens if path still has expected_version (None: it must not exist), otherwise PublishConflict.
+# On GCS that is a rewrite with an ifGenerationMatch precondition, elsewhere a check and a rename under a lock
+def publish_object(fs, path, data, expected_version=ANY_VERSION):
+    folder, name = path.rsplit('/', 1)
+    temporary_path = f"{folder}/.tmp/{name}.{uuid.uuid4().hex}"
+    with fs.open(temporary_path, 'wb') as f:
+        f.write(data)
+
+    try:
+        if 'gs' in (fs.protocol if isinstance(fs.protocol, (tuple, list)) else (fs.protocol,)):
+            _publish_gcs(fs, temporary_path, path, expected_version)
+        else:
+            with _publish_lock:
+                if expected_version is not ANY_VERSION and current_object_version(fs, path) != expected_version:
+                    raise PublishConflict(
+                        f"{path} was changed by someone else")
+                fs.mv(temporary_path, path)
+    finally:
+        try:
+            fs.rm(temporary_path)
+        except FileNotFoundError:
+            pass
+    fs.invalidate_cache(path)
+    cached_object_version.clear()
+
+
+# ifGenerationMatch takes the integer generation of the object (0: it must not exist),
+# versions are the 'generation:<n>' strings of info_version
+def version_generation(version):
+    if version is None:
+        return 0
+    key, _, generation = str(version).partition(':')
+    if key != 'generation' or not generation.isdigit():
+        raise ValueError(f"{version!r} is not a GCS generation")
+    return int(generation)
+
+
+def _publish_gcs(fs, temporary_path, path, expected_version):
+    source_bucket, source_key, _ = fs.split_path(temporary_path)
+    bucket, key, _ = fs.split_path(path)
+    precondition = {} if expected_version is ANY_VERSION else {
+        'ifGenerationMatch': version_generation(expected_version)}
+
+    try:
+        out = {'done': False}
+        rewrite_token = {}
+        while not out['done']:
+            out = fs.call('POST', 'b/{}/o/{}/rewriteTo/b/{}/o/{}', source_bucket, source_key, bucket, key,
+                          headers={'Content-Type': 'application/json'}, json_out=True,
+                          **precondition, **rewrite_token)
+            rewrite_token = {'rewriteToken': out.get('rewriteToken')}
+    except FileExistsError as e:
+        # gcsfs raises FileExistsError for 412 Precondition Failed
+        raise PublishConflict(f"{path} was changed by someone else") from e
+    except Exception as e:
+        if getattr(e, 'code', None) == 412:
+            raise PublishConflict(
+                f"{path} was changed by someone else") from e
+        raise
 
 #######################################
 # DYNAMIC REPORT DATA HANDLING
@@ -46,61 +1437,526 @@ def quarter_sort_key(p):
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-# This function returns a pkl file, which it forms from the data from the main folder
-def retrieve_pkl_data(periods_list, folder_path, conn, revenue_column, salary_column):
-    pkl_data = {}
+# Periods are loaded concurrently, this is the default limit of parallel GCS reads
+DYNAMIC_MAX_WORKERS = 8
 
-    for period in periods_list:
+
+# Aggregates one period in a worker thread. Previous entries with unchanged sources are reused.
+# With use_dataset, periods whose dataset partitions are current are left to dataset_period_cubes ('dataset').
+# Errors are returned instead of raised, so they can be reported from the script thread in period order
+def _build_period_entry(conn, folder_path, period, revenue_column, salary_column, previous_entry, use_dataset=False):
+    try:
+        sources = period_source_versions(conn, folder_path, period)
+    except Exception as e:
+        logging.error(f"Error listing files for period {period}: {e}")
+        sources = None
+
+    if (sources and None not in sources.values() and previous_entry is not None
+            and previous_entry.get('sources') == sources):
+        return 'reused', previous_entry
+
+    if use_dataset and sources:
         try:
-            MP = conn.read(
-                f"{folder_path}/{period}/MP_{period}.csv", input_format="csv", ttl=600)
-            RR = conn.read(
-                f"{folder_path}/{period}/RR_{period}.csv", input_format="csv", ttl=600)
+            if all(dataset_partition_is_current(conn.fs, folder_path.split('/')[-1], period, kind, sources[kind])
+                   for kind in ('MP', 'RR')):
+                return 'dataset', sources
         except Exception as e:
-            st.info(
-                f'Something went wrong while reading data for period {period}: {e}', icon='ℹ️')
-            logging.error(f"Error reading data for period {period}: {e}")
-            continue  # Skip this period and continue with the next one
-
+            logging.error(f"Error checking dataset partitions for period {period}: {e}")
+
+    # Only the aggregates are needed, so the exports are streamed instead of loaded whole
+    try:
+        cube = build_period_cube_streaming(
+            conn, folder_path, period, revenue_column, salary_column)
+    except Exception as e:
+        return 'read', e
+
+    return 'aggregated', (sources, cube)
+
+
+# Cubes of several periods of a practice from the dataset: one pruned read per export kind
+# instead of one file per period. Returns {period: cube} of the periods found in both kinds
+def dataset_period_cubes(conn, practice, periods, revenue_column, salary_column):
+    RR = load_dataset(conn, 'RR', practices=[practice], periods=periods,
+                      columns=['Practice Area', 'Client', revenue_column])
+    MP = load_dataset(conn, 'MP', practices=[practice], periods=periods,
+                      columns=['Practice Area', 'User', salary_column, 'Quantity'] + USER_HOURS_COLUMNS)
+
+    revenue = dict(tuple(RR.groupby('Period', sort=False)))
+    salary = dict(tuple(MP.groupby('Period', sort=False)))
+    return {period: build_period_cube(salary[period], revenue[period], revenue_column, salary_column)
+            for period in periods if period in revenue and period in salary}
+
+
+# Margin tables of the aggregated periods, computed in one batch by create_margin_tables
+# If the batch fails, the periods are computed one by one, so only the failing ones are reported
+# Returns ({period: margin table}, {period: error})
+def _margin_tables_by_period(cubes, revenue_column, salary_column):
+    if not cubes:
+        return {}, {}
+
+    try:
+        RR = pd.concat([cube['revenue'].assign(Quarter=period)
+                       for period, cube in cubes.items()], ignore_index=True)
+        MP = pd.concat([cube['salary'].assign(Quarter=period)
+                       for period, cube in cubes.items()], ignore_index=True)
+        long_table = create_margin_tables(
+            RR, MP, revenue_column, salary_column)
+
+        tables = {period: table.drop(columns='Quarter').reset_index(drop=True)
+                  for period, table in long_table.groupby('Quarter', sort=False)}
+        empty_table = long_table.iloc[0:0].drop(columns='Quarter')
+        return {period: tables.get(period, empty_table) for period in cubes}, {}
+    except Exception as e:
+        logging.error(f"Error creating margin tables in one batch: {e}")
+
+    tables, errors = {}, {}
+    for period, cube in cubes.items():
         try:
-            mt = create_margin_table(RR, MP, revenue_column, salary_column)
+            tables[period] = create_margin_table(
+                cube['revenue'], cube['salary'], revenue_column, salary_column)
         except Exception as e:
-            st.info(
-                f'Something went wrong (MT) for period {period}: {e}', icon='ℹ️')
-            logging.error(
-                f"Error creating margin table for period {period}: {e}")
-            continue  # Skip this period and continue with the next one
-
-        total_collected_time = mt[revenue_column].sum()
-        total_salaries = mt[salary_column].sum()
-
-        # Ensure the dictionary for this period is initialized
-        pkl_data[period] = {}
-        pkl_data[period]['margin_table'] = mt
-        pkl_data[period]['total_salaries'] = total_salaries
-        pkl_data[period]['total_collected_time'] = total_collected_time
-
-    # Convert to pkl
-    pkl_data = pickle.dumps(pkl_data)
-    return pkl_data
-
-# This function writes pkl file to gsm
-def write_pkl_to_gcs(pkl_data, folder_path, file_name, conn):
-    # Write PKL to GCS using the Streamlit connection
-    with conn.fs.open(f"{folder_path}/{file_name}", 'wb') as f:
-        f.write(pkl_data)
-    # st.success(
-    #     f'File successfully written to gs://{folder_path}/{file_name}')
+            errors[period] = e
+    return tables, errors
+
+
+# Dynamic data of one or more sources (practice folders) at once: one pool reads and aggregates every
+# (source, period), then the margin tables of each source are computed in one batch.
+# sources: {name: (folder_path, periods_list, revenue_column, salary_column)}, previous_data: {name: {period: entry}}
+# Returns {name: {period: entry}}, periods in the order of their periods_list
+def _retrieve_dynamic_entries(conn, sources, previous_data, max_workers, progress=None, notify=None):
+    # Background jobs collect the messages instead of writing them to a page
+    notify = notify or (lambda message: st.info(message, icon='ℹ️'))
+    entries = {name: {} for name in sources}
+    aggregated = {name: {} for name in sources}
+    from_dataset = {name: {} for name in sources}
+    use_dataset = dataset_enabled()
+
+    def label(name, period):
+        return period if len(sources) == 1 else f'{name} {period}'
+
+    def read_failed(name, period, error):
+        notify(
+            f'Something went wrong while reading data for period {label(name, period)}: {error}')
+        logging.error(
+            f"Error reading data for period {label(name, period)}: {error}")
+
+    with ThreadPoolExecutor(max_workers=max_workers, **script_run_ctx_initializer()) as io_pool:
+        futures = [(name, period, io_pool.submit(_build_period_entry, conn, folder_path, period, revenue_column,
+                                                 salary_column, previous_data.get(name, {}).get(period), use_dataset))
+                   for name, (folder_path, periods_list, revenue_column, salary_column) in sources.items()
+                   for period in periods_list]
+
+        for done, (name, period, future) in enumerate(futures, start=1):
+            status, result = future.result()
+            if progress is not None:
+                progress(done, len(futures))
+
+            if status == 'read':
+                read_failed(name, period, result)
+                continue  # Skip this period and continue with the next one
+
+            if status == 'reused':
+                entries[name][period] = result
+            elif status == 'dataset':
+                from_dataset[name][period] = result
+            else:
+                aggregated[name][period] = result
+
+    # Periods with current dataset partitions are read in one pass per practice,
+    # the ones it can't provide are streamed from their exports as usual
+    for name, periods in from_dataset.items():
+        if not periods:
+            continue
+        folder_path, _, revenue_column, salary_column = sources[name]
+        try:
+            cubes = dataset_period_cubes(conn, folder_path.split('/')[-1], list(periods),
+                                         revenue_column, salary_column)
+        except Exception as e:
+            logging.error(f"Error reading the dataset of {folder_path}: {e}")
+            cubes = {}
+
+        for period, period_sources in periods.items():
+            if period not in cubes:
+                try:
+                    cubes[period] = build_period_cube_streaming(
+                        conn, folder_path, period, revenue_column, salary_column)
+                except Exception as e:
+                    read_failed(name, period, e)
+                    continue
+            aggregated[name][period] = (period_sources, cubes[period])
+
+    dynamic_data = {}
+    for name, (folder_path, periods_list, revenue_column, salary_column) in sources.items():
+        margin_tables, errors = _margin_tables_by_period(
+            {period: cube for period, (sources_versions, cube) in aggregated[name].items()}, revenue_column, salary_column)
+
+        for period, (sources_versions, cube) in aggregated[name].items():
+            if period in errors:
+                notify(
+                    f'Something went wrong (MT) for period {label(name, period)}: {errors[period]}')
+                logging.error(
+                    f"Error creating margin table for period {label(name, period)}: {errors[period]}")
+                continue  # Skip this period and continue with the next one
+
+            mt = margin_tables[period]
+            total_collected_time = mt[revenue_column].sum()
+            total_salaries = mt[salary_column].sum()
+
+            # Ensure the dictionary for this period is initialized
+            entries[name][period] = {}
+            entries[name][period]['margin_table'] = mt
+            entries[name][period]['total_salaries'] = total_salaries
+            entries[name][period]['total_collected_time'] = total_collected_time
+            entries[name][period]['sources'] = sources_versions
+
+        dynamic_data[name] = {period: entries[name][period]
+                              for period in periods_list if period in entries[name]}
+        recomputed = len(aggregated[name]) - len(errors)
+        logging.info(
+            f"Dynamic data ({folder_path}): {recomputed} periods recomputed, {len(entries[name]) - recomputed} reused")
+
+    return dynamic_data
+
+
+# This function returns the dynamic data {period: entry}, which it forms from the data from the main folder
+# Every period entry remembers the versions of the MP/RR files it was built from ('sources').
+# Entries of previous_data whose sources haven't changed are reused instead of being read and recomputed.
+# Periods are read and aggregated by a pool of max_workers threads, then all margin tables are built in one pass.
+# The result keeps the order of periods_list.
+@timed('dynamic.build')
+def retrieve_dynamic_data(periods_list, folder_path, conn, revenue_column, salary_column, previous_data=None,
+                          max_workers=DYNAMIC_MAX_WORKERS, progress=None, notify=None):
+    return _retrieve_dynamic_entries(conn, {folder_path: (folder_path, periods_list, revenue_column, salary_column)},
+                                     {folder_path: previous_data or {}}, max_workers, progress, notify)[folder_path]
+
+
+# Firm-wide dynamic data: {practice: {period: entry}} of every practice in PRACTICES (or the given ones),
+# each with its own revenue and salary columns, built by one pool across practices and periods
+@timed('dynamic.build_firm')
+def retrieve_firm_data(conn, practices=None, previous_data=None, max_workers=DYNAMIC_MAX_WORKERS, progress=None,
+                       notify=None):
+    sources = {}
+    for practice in practices or PRACTICES:
+        folder_path = practice_folder(practice)
+        sources[practice] = (folder_path, create_periods_list(conn, folder_path),
+                             PRACTICES[practice]['revenue_column'], PRACTICES[practice]['salary_column'])
+
+    return _retrieve_dynamic_entries(conn, sources, previous_data or {}, max_workers, progress, notify)
+
+
+# The details of the dynamic store are a Parquet file (zstd): the margin tables of all period entries one after
+# another. The firm-wide store has the columns of every practice, entries with other columns than the file list them.
+# The header is the JSON value of the 'clio.dynamic' key of the file metadata (in the footer):
+#   {'schema_version': 1, 'layout': 'periods' ({period: entry}) | 'practices' ({practice: {period: entry}}),
+#    'entries': [{'practice', 'period', 'rows', 'columns' (None: those of the file), 'total_salaries',
+#                 'total_collected_time', 'sources'}]}
+# 'sources' are the versions of the MP/RR exports the entry was built from.
+# Readers only fetch the columns they ask for, and the row groups of the entries they ask for (read_dynamic_store)
+DYNAMIC_SCHEMA_VERSION = 1
+DYNAMIC_HEADER_KEY = b'clio.dynamic'
+DYNAMIC_COMPRESSION = 'zstd'
+DYNAMIC_ROW_GROUP_ROWS = 64 * 1024
+
+
+# [(practice or None, period, entry)] of the dynamic data of a layout
+def _dynamic_entries(data, layout):
+    if layout == 'periods':
+        return [(None, period, entry) for period, entry in data.items()]
+    return [(practice, period, entry) for practice, entries in data.items() for period, entry in entries.items()]
+
+
+# The dynamic data (dict of period entries, or of practices with layout='practices') as a dynamic store file
+def encode_dynamic_store(data, layout='periods'):
+    entries = _dynamic_entries(data, layout)
+    rows = pd.concat([entry['margin_table'] for _, _, entry in entries], ignore_index=True) if entries \
+        else pd.DataFrame()
+
+    # The header is stored twice in the footer (as is and in the Arrow schema), so it's kept compact
+    header = {'schema_version': DYNAMIC_SCHEMA_VERSION, 'layout': layout,
+              'entries': [{'practice': practice, 'period': period,
+                           'rows': len(entry['margin_table']),
+                           'columns': None if entry['margin_table'].columns.equals(rows.columns)
+                           else list(entry['margin_table'].columns),
+                           'total_salaries': float(entry['total_salaries']),
+                           'total_collected_time': float(entry['total_collected_time']),
+                           'sources': entry.get('sources')}
+                          for practice, period, entry in entries]}
+    table = pa.Table.from_pandas(rows, preserve_index=False).replace_schema_metadata(
+        {DYNAMIC_HEADER_KEY: json.dumps(header, separators=(',', ':'))})
+
+    # Amounts compress much better byte-split, the rest (practice areas) is dictionary-encoded
+    amounts = [field.name for field in table.schema if pa.types.is_floating(field.type)]
+    buffer = pa.BufferOutputStream()
+    pq.write_table(table, buffer, compression=DYNAMIC_COMPRESSION, row_group_size=DYNAMIC_ROW_GROUP_ROWS,
+                   use_byte_stream_split=amounts,
+                   use_dictionary=[name for name in table.column_names if name not in amounts],
+                   write_statistics=False)
+    return buffer.getvalue().to_pybytes()
+
+
+def read_dynamic_header(parquet_file):
+    header = json.loads(parquet_file.schema_arrow.metadata[DYNAMIC_HEADER_KEY])
+    if header['schema_version'] > DYNAMIC_SCHEMA_VERSION:
+        raise ValueError(
+            f"Dynamic store schema version {header['schema_version']} is newer than this app ({DYNAMIC_SCHEMA_VERSION})")
+    return header
+
+
+# Dynamic data of a dynamic store file, optionally only some periods, practices (firm-wide store)
+# and margin table columns. Returns it in the layout it was written with
+def read_dynamic_store(f, periods=None, columns=None, practices=None):
+    parquet_file = pq.ParquetFile(f)
+    header = read_dynamic_header(parquet_file)
+    for entry in header['entries']:
+        entry['columns'] = entry['columns'] or parquet_file.schema_arrow.names
+
+    # First row of every entry and of every row group in the file
+    entry_starts = np.cumsum([0] + [entry['rows'] for entry in header['entries']])
+    group_starts = np.cumsum([0] + [parquet_file.metadata.row_group(group).num_rows
+                                    for group in range(parquet_file.num_row_groups)])
+    selected = [(start, entry) for start, entry in zip(entry_starts, header['entries'])
+                if (periods is None or entry['period'] in periods)
+                and (practices is None or entry['practice'] in practices)]
+
+    # Row groups that hold rows of the selected entries
+    groups = sorted({group for start, entry in selected
+                     for group in range(np.searchsorted(group_starts, start, side='right') - 1,
+                                        np.searchsorted(group_starts, start + entry['rows'], side='left'))})
+    read_columns = list(dict.fromkeys(column for _, entry in selected for column in entry['columns']
+                                      if columns is None or column in columns))
+    frame = parquet_file.read_row_groups(groups, columns=read_columns).to_pandas()
+    # First row of every read row group in the frame
+    frame_starts = dict(zip(groups, np.cumsum([0] + [group_starts[group + 1] - group_starts[group]
+                                                     for group in groups])))
+
+    data = {}
+    for start, entry in selected:
+        entry_columns = [column for column in entry['columns'] if columns is None or column in columns]
+        if entry['rows']:
+            group = np.searchsorted(group_starts, start, side='right') - 1
+            offset = frame_starts[group] + start - group_starts[group]
+            margin_table = frame.iloc[offset:offset + entry['rows']]
+        else:
+            margin_table = frame.iloc[0:0]
+        # Selecting the columns is the slow part, it's only needed by entries with other columns
+        if list(margin_table.columns) != entry_columns:
+            margin_table = margin_table[entry_columns]
+        margin_table = margin_table.reset_index(drop=True)
+
+        entries = data if header['layout'] == 'periods' else data.setdefault(entry['practice'], {})
+        entries[entry['period']] = {'margin_table': margin_table,
+                                    'total_salaries': entry['total_salaries'],
+                                    'total_collected_time': entry['total_collected_time'],
+                                    'sources': entry['sources']}
+    return data
+
+
+# Publishes the dynamic data as the details object of the dynamic store
+def write_dynamic_store(conn, dynamic_folder_path, dynamic_file_name, data, layout='periods',
+                        expected_version=ANY_VERSION):
+    path = f"{dynamic_folder_path}/{dynamic_file_name}"
+    store = encode_dynamic_store(data, layout)
+    # Readers see the old or the new object, never a partial one
+    with timed_stage('dynamic.write', file=path, bytes_written=len(store)):
+        publish_object(conn.fs, path, store, expected_version)
+
+
+# Reads the dynamic data (dict of period entries) from the cloud, see read_dynamic_store for the selection
+# A store that only exists as the pickle of earlier versions is migrated first
+def load_dynamic_data(conn, dynamic_folder_path, dynamic_file_name, periods=None, columns=None, practices=None):
+    path = f"{dynamic_folder_path}/{dynamic_file_name}"
+    try:
+        f = conn.fs.open(path, 'rb')
+    except FileNotFoundError:
+        migrate_dynamic_store(conn, dynamic_folder_path, dynamic_file_name)
+        f = conn.fs.open(path, 'rb')
+
+    with timed_stage('dynamic.load', file=path) as record:
+        with CountingFile(f, record) as f:
+            return read_dynamic_store(f, periods, columns, practices)
+
+
+# Earlier versions stored the details as a pickled dict next to the summary: <name>.pkl
+def legacy_dynamic_name(dynamic_file_name):
+    return f"{os.path.splitext(dynamic_file_name)[0]}.pkl"
+
+
+# Converts the pickled details to the dynamic store format, unless someone else has done it meanwhile.
+# The pickle is left in place. Raises FileNotFoundError if there is no pickle either
+def migrate_dynamic_store(conn, dynamic_folder_path, dynamic_file_name):
+    legacy_path = f"{dynamic_folder_path}/{legacy_dynamic_name(dynamic_file_name)}"
+    with timed_stage('dynamic.migrate', file=legacy_path) as record:
+        with CountingFile(conn.fs.open(legacy_path, 'rb'), record) as f:
+            data = pickle.load(f)
+
+    # The firm-wide pickle is {practice: {period: entry}}
+    layout = 'periods' if all('margin_table' in entry for entry in data.values()) else 'practices'
+    try:
+        write_dynamic_store(conn, dynamic_folder_path, dynamic_file_name, data, layout, expected_version=None)
+        logging.info(f"Migrated {legacy_path} to {dynamic_folder_path}/{dynamic_file_name}")
+    except PublishConflict:
+        pass
+
+
+# The dynamic store is two objects in dynamic_folder_path:
+#   <name>.parquet       details: the margin table of every period, needed by the practice area and yearly sections
+#   <name>_summary.json  summary index: the totals of every period, a few hundred bytes the page renders first
+def dynamic_summary_name(dynamic_file_name):
+    return f"{os.path.splitext(dynamic_file_name)[0]}_summary.json"
+
+
+# {period: {'total_salaries': ..., 'total_collected_time': ...}} of the dynamic data, in period order
+def dynamic_summary(dynamic_data):
+    return {period: {'total_salaries': float(entry['total_salaries']),
+                     'total_collected_time': float(entry['total_collected_time'])}
+            for period, entry in dynamic_data.items()}
+
+
+def write_dynamic_summary(conn, dynamic_folder_path, dynamic_file_name, summary, expected_version=ANY_VERSION):
+    path = f"{dynamic_folder_path}/{dynamic_summary_name(dynamic_file_name)}"
+    with timed_stage('dynamic.write_summary', file=path):
+        publish_object(conn.fs, path, json.dumps(
+            {'periods': summary}).encode('utf-8'), expected_version)
+
+
+# Same table as the second frame of pkl_to_two_dfs (quarter, total_salaries, total_collected_time)
+def summary_table(summary):
+    return pd.DataFrame([{'quarter': period, **totals} for period, totals in summary.items()],
+                        columns=['quarter', 'total_salaries', 'total_collected_time'])
+
+
+# Summary index of the dynamic store as a table, cached until the object changes.
+# Stores written before the summary index existed get it built from the details (once)
+def load_dynamic_summary(conn, dynamic_folder_path, dynamic_file_name):
+    path = f"{dynamic_folder_path}/{dynamic_summary_name(dynamic_file_name)}"
+    try:
+        summary = load_json_object(conn, path)['periods']
+    except FileNotFoundError:
+        summary = dynamic_summary(load_dynamic_details(
+            conn, dynamic_folder_path, dynamic_file_name))
+        try:
+            write_dynamic_summary(
+                conn, dynamic_folder_path, dynamic_file_name, summary)
+        except Exception as e:
+            logging.error(f"Error writing dynamic summary {path}: {e}")
+
+    return summary_table(summary)
+
+
+# A small JSON object of the bucket, cached in the shared cache until the object changes (see cached_object_version)
+def load_json_object(conn, path):
+    version = cached_object_version(conn, path)
+
+    def read_json():
+        with timed_stage('dynamic.load_summary', file=path) as record:
+            with CountingFile(conn.fs.open(path, 'rb'), record) as f:
+                return json.load(f)
+
+    return period_cache().get_or_compute(('dynamic_summary', path, version), read_json)
+
+
+# Details of the dynamic store (load_dynamic_data), cached by selection until the object changes (see cached_object_version)
+def load_dynamic_details(conn, dynamic_folder_path, dynamic_file_name, periods=None, columns=None, practices=None):
+    path = f"{dynamic_folder_path}/{dynamic_file_name}"
+    try:
+        version = cached_object_version(conn, path)
+    except FileNotFoundError:
+        migrate_dynamic_store(conn, dynamic_folder_path, dynamic_file_name)
+        version = cached_object_version(conn, path)
+
+    selection = tuple(None if values is None else tuple(values) for values in (periods, columns, practices))
+    return period_cache().get_or_compute(('dynamic', path, version) + selection,
+                                         lambda: load_dynamic_data(conn, dynamic_folder_path, dynamic_file_name,
+                                                                   periods, columns, practices))
 
 # This function uses previous functions to a) retrieve data from main cloud and b) upload it, replacing the existing file
-# Returns pkl file
-def refresh_and_upload_data(periods_list, folder_path, revenue_column, salary_column, dynamic_folder_path, dynamic_file_name, conn):
-    pkl_data = retrieve_pkl_data(
-        periods_list, folder_path, conn, revenue_column, salary_column)
-    write_pkl_to_gcs(
-        pkl_data, dynamic_folder_path, dynamic_file_name, conn)
+# Only new or changed periods are recomputed unless full_rebuild is set
+# Both objects are published atomically and only if nobody else published them since the refresh started (PublishConflict)
+# progress(done, total) and notify(message) are passed to retrieve_dynamic_data
+# Returns the dynamic data
+def refresh_and_upload_data(periods_list, folder_path, revenue_column, salary_column, dynamic_folder_path, dynamic_file_name, conn, full_rebuild=False,
+                            max_workers=DYNAMIC_MAX_WORKERS, progress=None, notify=None):
+    details_path = f"{dynamic_folder_path}/{dynamic_file_name}"
+    summary_path = f"{dynamic_folder_path}/{dynamic_summary_name(dynamic_file_name)}"
+    details_version = current_object_version(conn.fs, details_path)
+    summary_version = current_object_version(conn.fs, summary_path)
+
+    previous_data = None
+    if not full_rebuild:
+        try:
+            previous_data = load_dynamic_data(
+                conn, dynamic_folder_path, dynamic_file_name)
+        except Exception as e:
+            logging.error(
+                f"No previous dynamic data to reuse, rebuilding all periods: {e}")
+
+    # Loading the previous data publishes the store if only the legacy pickle existed
+    if details_version is None:
+        details_version = current_object_version(conn.fs, details_path)
+
+    dynamic_data = retrieve_dynamic_data(
+        periods_list, folder_path, conn, revenue_column, salary_column, previous_data, max_workers, progress, notify)
+    write_dynamic_store(conn, dynamic_folder_path, dynamic_file_name,
+                        dynamic_data, expected_version=details_version)
+    # The summary goes last, so it never lists periods the details don't have yet
+    write_dynamic_summary(conn, dynamic_folder_path, dynamic_file_name,
+                          dynamic_summary(dynamic_data), summary_version)
     # st.success("Data refreshed and uploaded successfully!")
-    return pkl_data
+    return dynamic_data
+
+# The firm-wide dynamic store: details {practice: {period: entry}} and a summary {practice: {period: totals}}
+# next to the management store, refreshed by refresh_firm_data (from the Dynamic Reports page)
+DYNAMIC_FOLDER_PATH = f"{BUCKET_ROOT}/dynamic"
+FIRM_DYNAMIC_FILE_NAME = 'firm_dynamic_data.parquet'
+
+
+# refresh_and_upload_data for the firm-wide store, every practice folder in one parallel pass
+# Returns the dynamic data {practice: {period: entry}}
+def refresh_firm_data(conn, dynamic_folder_path=DYNAMIC_FOLDER_PATH, firm_file_name=FIRM_DYNAMIC_FILE_NAME,
+                      full_rebuild=False, max_workers=DYNAMIC_MAX_WORKERS, progress=None, notify=None):
+    details_path = f"{dynamic_folder_path}/{firm_file_name}"
+    summary_path = f"{dynamic_folder_path}/{dynamic_summary_name(firm_file_name)}"
+    details_version = current_object_version(conn.fs, details_path)
+    summary_version = current_object_version(conn.fs, summary_path)
+
+    previous_data = None
+    if not full_rebuild:
+        try:
+            previous_data = load_dynamic_data(
+                conn, dynamic_folder_path, firm_file_name)
+        except Exception as e:
+            logging.error(
+                f"No previous firm-wide data to reuse, rebuilding all periods: {e}")
+
+    # Loading the previous data publishes the store if only the legacy pickle existed
+    if details_version is None:
+        details_version = current_object_version(conn.fs, details_path)
+
+    dynamic_data = retrieve_firm_data(
+        conn, None, previous_data, max_workers, progress, notify)
+    write_dynamic_store(conn, dynamic_folder_path, firm_file_name,
+                        dynamic_data, 'practices', details_version)
+    summary = {practice: dynamic_summary(entries)
+               for practice, entries in dynamic_data.items()}
+    with timed_stage('dynamic.write_summary', file=summary_path):
+        publish_object(conn.fs, summary_path, json.dumps(
+            {'practices': summary}).encode('utf-8'), summary_version)
+    return dynamic_data
+
+
+# Per-quarter totals of one practice from the firm-wide summary (quarter, total_salaries, total_collected_time),
+# None if the firm-wide store hasn't been built yet or doesn't have the practice
+def practice_trend_table(conn, practice, dynamic_folder_path=DYNAMIC_FOLDER_PATH, firm_file_name=FIRM_DYNAMIC_FILE_NAME):
+    try:
+        summary = load_json_object(
+            conn, f"{dynamic_folder_path}/{dynamic_summary_name(firm_file_name)}")['practices']
+    except FileNotFoundError:
+        return None
+    if practice not in summary:
+        return None
+
+    return summary_table(summary[practice]).sort_values(
+        by='quarter', key=lambda col: col.map(quarter_sort_key)).reset_index(drop=True)
 
 # Forms two dfs from the pkl file
 
@@ -174,12 +2030,302 @@ def build_yearly_table(full_table):
                                     'Margin, %', 'x2 Salary', 'Margin with x2 Salary, USD', 'Margin with x2 Salary, %']]
     return yearly_summary
 
+#######################################
+# BACKGROUND REFRESH
+#######################################
+
+# Refresh of the dynamic data running in a background thread, the page polls it for progress
+class RefreshJob:
+    def __init__(self, key):
+        self.key = key
+        self.id = uuid.uuid4().hex
+        self.state = 'running'
+        self.done = 0
+        self.total = 0
+        self.messages = []
+        self.error = None
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def running(self):
+        return self.state == 'running'
+
+    def set_progress(self, done, total):
+        self.done, self.total = done, total
+
+
+# Jobs of the process by (folder_path, dynamic_folder_path, dynamic_file_name), the last one of each is kept
+# The firm-wide store uses BUCKET_ROOT as its folder_path, the dataset backfill (BUCKET_ROOT, DATASET_ROOT, 'backfill')
+class RefreshJobs:
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._jobs.get(key)
+
+    # Starts a job for key, or returns the one that is already running
+    def start(self, key, run):
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.running:
+                return job
+            job = RefreshJob(key)
+            self._jobs[key] = job
+
+        def target():
+            try:
+                run(job)
+                job.state = 'done'
+            except Exception as e:
+                logging.error(f"Dynamic data refresh failed: {e}")
+                job.error = e
+                job.state = 'failed'
+            finally:
+                job.finished = time.time()
+
+        thread = threading.Thread(
+            target=target, name=f'{BACKGROUND_THREAD_PREFIX}-refresh-{job.id[:8]}', daemon=True)
+        thread.start()
+        return job
+
+
+@st.cache_resource
+def refresh_jobs():
+    return RefreshJobs()
+
+
+# Last refresh job of a dynamic store (None if there was none since the server started)
+def dynamic_refresh_job(folder_path, dynamic_folder_path, dynamic_file_name):
+    return refresh_jobs().get((folder_path, dynamic_folder_path, dynamic_file_name))
+
+
+# Starts refresh_and_upload_data in the background, concurrent requests share one job.
+# The period list is read again (catalog refreshed) when the job starts
+def start_refresh_job(conn, folder_path, revenue_column, salary_column, dynamic_folder_path, dynamic_file_name,
+                      full_rebuild=False):
+    def run(job):
+        refresh_period_catalog(conn, folder_path, force=True, write_manifest=True)
+        periods_list = create_periods_list(conn, folder_path)
+        refresh_and_upload_data(periods_list, folder_path, revenue_column, salary_column, dynamic_folder_path,
+                                dynamic_file_name, conn, full_rebuild, progress=job.set_progress,
+                                notify=job.messages.append)
+
+    return refresh_jobs().start((folder_path, dynamic_folder_path, dynamic_file_name), run)
+
+
+# Background refresh of the firm-wide store, shown by refresh_status(BUCKET_ROOT, dynamic_folder_path, firm_file_name)
+def start_firm_refresh_job(conn, dynamic_folder_path=DYNAMIC_FOLDER_PATH, firm_file_name=FIRM_DYNAMIC_FILE_NAME,
+                           full_rebuild=False):
+    def run(job):
+        for practice in PRACTICES:
+            refresh_period_catalog(conn, practice_folder(practice), force=True, write_manifest=True)
+        refresh_firm_data(conn, dynamic_folder_path, firm_file_name, full_rebuild,
+                          progress=job.set_progress, notify=job.messages.append)
+
+    return refresh_jobs().start((BUCKET_ROOT, dynamic_folder_path, firm_file_name), run)
+
+
+DATASET_BACKFILL_NAME = 'backfill'
+
+
+# Background backfill of the partitioned dataset from the periods of every practice,
+# shown by refresh_status(BUCKET_ROOT, DATASET_ROOT, DATASET_BACKFILL_NAME). Progress counts practices
+def start_dataset_backfill_job(conn):
+    def run(job):
+        written = 0
+        for done, practice in enumerate(PRACTICES, start=1):
+            refresh_period_catalog(conn, practice_folder(practice), force=True, write_manifest=True)
+            written += write_practice_dataset(conn, practice)
+            job.set_progress(done, len(PRACTICES))
+        job.messages.append(f'Dataset backfill: {written} partitions written')
+
+    return refresh_jobs().start((BUCKET_ROOT, DATASET_ROOT, DATASET_BACKFILL_NAME), run)
+
+
+# Progress bar of a refresh job, or its outcome once this session has reloaded the page after it finished
+def refresh_status(folder_path, dynamic_folder_path, dynamic_file_name):
+    job = dynamic_refresh_job(
+        folder_path, dynamic_folder_path, dynamic_file_name)
+    if job is None:
+        return
+
+    if job.running or st.session_state.get('refresh_jobs_shown', {}).get(job.key) != job.id:
+        refresh_progress(job)
+    elif job.state == 'failed':
+        st.error(f'Data refresh failed: {job.error}', icon='🚨')
+    else:
+        for message in job.messages:
+            st.info(message, icon='ℹ️')
+
+
+# Polls the job every 2 seconds while it runs, only this fragment reruns.
+# When the job finishes, the whole page reruns once, so it shows the new data
+@st.experimental_fragment(run_every=2)
+def refresh_progress(job):
+    if job.running:
+        st.progress(job.done / job.total if job.total else 0.0,
+                    text=f'Refreshing data: {job.done}/{job.total or "?"} periods')
+    else:
+        st.session_state.setdefault('refresh_jobs_shown', {})[
+            job.key] = job.id
+        st.rerun()
+
+#######################################
+# EXPORT
+#######################################
+
+# Tables are written to a temporary file EXPORT_CHUNK_ROWS rows at a time, so apart from the finished file
+# (which st.download_button needs as bytes) only one chunk is held in memory.
+# Several tables become one sheet each in Excel and a zip with one file each in CSV/Parquet
+EXPORT_FORMATS = {
+    'CSV': ('csv', 'text/csv'),
+    'Parquet': ('parquet', 'application/vnd.apache.parquet'),
+    'Excel': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+EXPORT_CHUNK_ROWS = 50_000
+# Rows of an Excel sheet, bigger tables continue on "<name> (2)", ...
+EXCEL_MAX_ROWS = 1_048_576
+
+
+def _chunks(df):
+    for start in range(0, max(len(df), 1), EXPORT_CHUNK_ROWS):
+        yield df.iloc[start:start + EXPORT_CHUNK_ROWS]
+
+
+def _write_csv(df, f):
+    text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+    for number, chunk in enumerate(_chunks(df)):
+        chunk.to_csv(text, header=number == 0, index=False)
+    # Leaves f open
+    text.detach()
+
+
+def _write_parquet(df, f):
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    with pq.ParquetWriter(f, schema, compression='zstd') as writer:
+        for chunk in _chunks(df):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+
+# constant_memory makes xlsxwriter flush every row to a temporary file, so sheets are written row by row in order
+def _write_excel(tables, f):
+    workbook = xlsxwriter.Workbook(f, {'constant_memory': True, 'nan_inf_to_errors': True,
+                                       'remove_timezone': True, 'default_date_format': 'yyyy-mm-dd'})
+    for name, df in tables.items():
+        for part, start in enumerate(range(0, max(len(df), 1), EXCEL_MAX_ROWS - 1)):
+            # Sheet names are at most 31 characters and can't contain []:*?/\
+            sheet_name = re.sub(r'[\[\]:*?/\\]', ' ', name)[:31 - 5 * bool(part)]
+            worksheet = workbook.add_worksheet(sheet_name if not part else f'{sheet_name} ({part + 1})')
+            worksheet.write_row(0, 0, [str(column) for column in df.columns])
+            row = 1
+            for chunk in _chunks(df.iloc[start:start + EXCEL_MAX_ROWS - 1]):
+                values = chunk.astype(object).where(chunk.notna(), None)
+                for values_row in values.itertuples(index=False, name=None):
+                    worksheet.write_row(row, 0, values_row)
+                    row += 1
+    workbook.close()
+
+
+# File of the tables ({name: DataFrame}) in one of EXPORT_FORMATS, as bytes
+def export_tables(tables, export_format):
+    extension, _ = EXPORT_FORMATS[export_format]
+    write = _write_csv if extension == 'csv' else _write_parquet
+
+    with timed_stage('export', format=extension, tables=len(tables),
+                     rows=sum(len(df) for df in tables.values())) as record:
+        with tempfile.TemporaryFile() as f:
+            if extension == 'xlsx':
+                _write_excel(tables, f)
+            elif len(tables) == 1:
+                write(next(iter(tables.values())), f)
+            else:
+                with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED) as archive:
+                    for name, df in tables.items():
+                        # Parquet needs a seekable file, every member goes through its own temporary file
+                        with tempfile.TemporaryFile() as member:
+                            write(df, member)
+                            member.seek(0)
+                            with archive.open(f'{name}.{extension}', 'w') as archive_member:
+                                shutil.copyfileobj(member, archive_member)
+
+            record['bytes_written'] = f.tell()
+            f.seek(0)
+            return f.read()
+
+
+# Download of tables ({name: DataFrame}) as file_name.<extension>. The file is only built when
+# "Prepare download" is clicked, the download button is shown on that run
+def export_downloads(tables, key, file_name):
+    format_column, button_column = st.columns((3, 1))
+    with format_column:
+        export_format = st.radio('Export format', list(EXPORT_FORMATS), horizontal=True,
+                                 key=f'{key}_export_format', label_visibility='collapsed')
+    with button_column:
+        if not st.button('Prepare download', key=f'{key}_export_prepare'):
+            return
+
+        extension, mime = EXPORT_FORMATS[export_format]
+        if extension != 'xlsx' and len(tables) > 1:
+            extension, mime = 'zip', 'application/zip'
+        try:
+            with st.spinner('Preparing the file...'):
+                data = export_tables(tables, export_format)
+        except Exception as e:
+            st.error(f'Something went wrong while preparing the file: {e}')
+            logging.error(f"Error exporting {file_name}: {e}")
+            return
+        st.download_button('Download', data, file_name=f'{file_name}.{extension}', mime=mime,
+                           key=f'{key}_export_download')
+
+
 #######################################
 # VIZUALIZATION METHODS AND FUNCTIONS
 #######################################
 
+FIGURE_CACHE_ENTRIES = 64
+
+
+# Finished figures shared by all sessions, keyed by a fingerprint of their input data and parameters
+@st.cache_resource
+def figure_cache():
+    return LRUCache(FIGURE_CACHE_ENTRIES, cache_ceiling('figure_cache_mb'))
+
+
+# Cheap content hash of a DataFrame: row hashes plus column names and dtypes
+def data_fingerprint(df):
+    h = hashlib.sha1()
+    h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    h.update(repr(list(df.columns)).encode('utf-8'))
+    h.update(repr(list(df.dtypes.astype(str))).encode('utf-8'))
+    return h.hexdigest()
+
+
+# Returns build_figure(*args), reusing the figure built earlier for the same data and parameters
+# DataFrame arguments are keyed by their fingerprint, the others by value. Cached figures are shared, don't modify them
+def cached_figure(build_figure, *args):
+    key = (build_figure.__name__,) + tuple(
+        data_fingerprint(arg) if isinstance(arg, pd.DataFrame) else repr(arg) for arg in args)
 
+    with timed_stage('figure', name=build_figure.__name__, cache='hit') as record:
+        def build():
+            record['cache'] = 'miss'
+            return build_figure(*args)
+
+        return figure_cache().get_or_compute(key, build)
+
+
+
+@timed('chart')
 def plot_metric(label, value, prefix="", suffix=""):
+    # Render
+    st.plotly_chart(cached_figure(_metric_figure, label, value, prefix, suffix),
+                    use_container_width=True)
+
+
+def _metric_figure(label, value, prefix="", suffix=""):
     fig = go.Figure()
 
     fig.add_trace(
@@ -208,18 +2354,31 @@ def plot_metric(label, value, prefix="", suffix=""):
         height=100,
     )
 
-    st.plotly_chart(fig, use_container_width=True)
+    return fig
 
 
 def create_margin_table(RR, MP, revenue_column, salary_column):
-    temp = RR.groupby(['Practice Area'], dropna=False)[revenue_column].sum()
-    temp = temp.to_frame()
-    temp_dict = temp.to_dict()[revenue_column]
+    return create_margin_tables(RR, MP, revenue_column, salary_column, period_column=None)
 
-    margin_table = MP.groupby(['Practice Area'], dropna=False)[
+
+# Margin tables of many periods at once: RR and MP hold the rows of several periods with a period_column.
+# One grouped pass per export and one join compute every (period, Practice Area) row.
+# Returns the long table that pkl_to_two_dfs builds (margin table columns + period_column)
+@timed('margin_table')
+def create_margin_tables(RR, MP, revenue_column, salary_column, period_column='Quarter'):
+    keys = ['Practice Area'] if period_column is None else [
+        period_column, 'Practice Area']
+
+    revenue = RR.groupby(keys, dropna=False, observed=True)[
+        revenue_column].sum().reset_index()
+    margin_table = MP.groupby(keys, dropna=False, observed=True)[
         salary_column].sum().reset_index()
 
-    margin_table[revenue_column] = margin_table['Practice Area'].map(temp_dict)
+    # Plain labels, so tables of different periods concatenate the same way whatever the input dtypes
+    for frame in (revenue, margin_table):
+        frame[keys] = frame[keys].astype(object)
+
+    margin_table = margin_table.merge(revenue, on=keys, how='left')
     margin_table['Margin, %'] = (margin_table[revenue_column] -
                                  margin_table[salary_column]) / margin_table[revenue_column] * 100
 
@@ -228,10 +2387,28 @@ def create_margin_table(RR, MP, revenue_column, salary_column):
     margin_table['Delta of Revenue and x2 Salary'] = margin_table[revenue_column] - \
         margin_table['x2 Salary']
 
+    if period_column is not None:
+        # Same column order as pkl_to_two_dfs: the period goes last
+        margin_table = margin_table[[
+            column for column in margin_table.columns if column != period_column] + [period_column]]
+
     return margin_table
 
 
+# Margin table of a period cube, memoized so reruns from unrelated widgets don't rebuild it
+@st.cache_data(show_spinner=False, max_entries=DATA_CACHE_ENTRIES, ttl=DATA_CACHE_TTL)
+def cube_margin_table(revenue, salary, revenue_column, salary_column):
+    return create_margin_table(revenue, salary, revenue_column, salary_column)
+
+
+@timed('chart')
 def plot_chart_salary_and_collected_time(margin_table, salary_column, revenue_column, currency_label):
+    # Render
+    st.plotly_chart(cached_figure(_salary_and_collected_time_figure, margin_table, salary_column,
+                                  revenue_column, currency_label), use_container_width=True)
+
+
+def _salary_and_collected_time_figure(margin_table, salary_column, revenue_column, currency_label):
     # Create a bar chart from margin table
     fig = go.Figure()
     fig.add_trace(go.Bar(x=margin_table['Practice Area'],
@@ -244,9 +2421,11 @@ def plot_chart_salary_and_collected_time(margin_table, salary_column, revenue_co
                          marker_color='rgb(26, 100, 255)'))
     fig.update_layout(barmode='group', title='Matter Cost in Salary and Revenue by Practice',
                       legend=dict(y=1.1, orientation='h'))
-    st.plotly_chart(fig, use_container_width=True)
+
+    return fig
 
 
+@timed('chart')
 def show_margin_table(margin_table, salary_column, revenue_column, currency_label):
     st.write(' ')
     st.write(' ')
@@ -274,24 +2453,29 @@ def show_margin_table(margin_table, salary_column, revenue_column, currency_labe
                  use_container_width=True, column_config=format_config)
 
 
-# def client_contribution(RR, revenue_column):
-#     st.write('')
-#     st.write('')
-#     st.markdown("**Client's contribution to collected time**")
-#     n = st.slider("Pick a %", 0, 100, value=20, step=5)/100
-#     client_contribution = RR.groupby(
-#         'Client')[revenue_column].sum().reset_index()
-#     top_clients = client_contribution.sort_values(
-#         revenue_column, ascending=False).head(int(len(client_contribution) * n))
-#     other_clients = client_contribution[~client_contribution['Client'].isin(
-#         top_clients['Client'])]
-#     other_clients = pd.DataFrame({'Client': ['Other'], revenue_column: [
-#         other_clients[revenue_column].sum()]},)
-#     grouped_data = pd.concat([top_clients, other_clients])
-#     fig = px.pie(grouped_data, names='Client', values=revenue_column,
-#                  title=f'Top {round(n*100)}% Clients Contribution to Revenue', hole=0.3)
-#     st.plotly_chart(fig, use_container_width=True)
+# Clients of a practice area ("All" for the whole period) ranked by revenue, with the running total
+# Cached per revenue table and practice area, so moving the slider only slices it
+@st.cache_data(show_spinner=False, max_entries=DATA_CACHE_ENTRIES, ttl=DATA_CACHE_TTL)
+def rank_client_revenue(RR, revenue_column, practice_area):
+    if practice_area != "All":
+        RR = RR[RR['Practice Area'] == practice_area]
+
+    ranked = RR.groupby('Client', observed=True)[revenue_column].sum().sort_values(
+        ascending=False).reset_index()
+    ranked['Client'] = ranked['Client'].astype(object)
+    ranked['Cumulative'] = ranked[revenue_column].cumsum()
+    return ranked
+
+
+# Runs as a fragment: the selectbox and the slider only rerun this chart, not the whole page
+@st.experimental_fragment
 def client_contribution(RR, revenue_column):
+    render_client_contribution(RR, revenue_column)
+
+
+# The chart itself, for pages that already render it inside a fragment of their own (fragments can't be nested)
+@timed('chart')
+def render_client_contribution(RR, revenue_column):
     st.write('')
     st.write('')
     st.markdown("**Client's contribution to collected time**")
@@ -301,26 +2485,22 @@ def client_contribution(RR, revenue_column):
     practice_area = st.selectbox("Select Practice Area", [
                                  "All"] + practice_areas)
 
-    # Filter the data based on the selected Practice Area
-    if practice_area != "All":
-        RR = RR[RR['Practice Area'] == practice_area]
-
     n = st.slider("Pick a %", 0, 100, value=20, step=5) / 100
 
-    # Aggregate revenue
-    client_contribution = RR.groupby(
-        'Client')[revenue_column].sum().reset_index()
-    top_clients = client_contribution.sort_values(
-        revenue_column, ascending=False).head(int(len(client_contribution) * n))
+    # Top clients are a slice of the ranking, everything after it is "Other"
+    ranked = rank_client_revenue(RR, revenue_column, practice_area)
+    top_count = int(len(ranked) * n)
+    top_clients = ranked.head(top_count)
 
-    other_clients = client_contribution[~client_contribution['Client'].isin(
-        top_clients['Client'])]
+    total = ranked['Cumulative'].iloc[-1] if len(ranked) else 0
+    top_total = ranked['Cumulative'].iloc[top_count - 1] if top_count else 0
     other_clients = pd.DataFrame({
         'Client': ['Other'],
-        revenue_column: [other_clients[revenue_column].sum()]
+        revenue_column: [total - top_total]
     })
 
-    grouped_data = pd.concat([top_clients, other_clients])
+    grouped_data = pd.concat(
+        [top_clients[['Client', revenue_column]], other_clients])
 
     # ---- SHORT LABELS + FULL HOVER ----
     MAX_LEN = 30
@@ -357,14 +2537,21 @@ def client_contribution(RR, revenue_column):
 
 
 
+@timed('chart')
 def hours_by_practice(MP):
+    # Display the plot in Streamlit
+    st.plotly_chart(cached_figure(_hours_by_practice_figure, MP),
+                    use_container_width=True)
+
+
+def _hours_by_practice_figure(MP):
     # Calculate total hours per user and use it to order the User axis
     user_totals = MP.groupby(
-        'User')['Quantity'].sum().sort_values(ascending=True)
+        'User', observed=True)['Quantity'].sum().sort_values(ascending=True)
     user_order = user_totals.index.tolist()  # List of users sorted by total hours
 
     # Group data by User and Practice Area, then sum the hours (Quantity)
-    grouped_data = MP.groupby(['User', 'Practice Area'])[
+    grouped_data = MP.groupby(['User', 'Practice Area'], observed=True)[
         'Quantity'].sum().reset_index()
 
     # Create the stacked bar plot, specifying the user order in `category_orders`
@@ -380,24 +2567,25 @@ def hours_by_practice(MP):
         category_orders={'User': user_order}  # Sort User axis by total hours
     )
 
-    # Add total hours annotations for each user
-    for user, total_hours in user_totals.items():
-        fig.add_annotation(
-            x=total_hours,
-            y=user,
-            text=f"{total_hours:.0f}",  # Display total hours (rounded)
-            showarrow=False,
-            font=dict(size=12, color="black"),
-            xshift=10  # Offset text slightly to avoid overlap
-        )
+    # Total hours of every user as one text trace next to the end of the bars
+    fig.add_trace(go.Scatter(
+        x=user_totals.values,
+        y=user_order,
+        text=[f"{total_hours:.0f}" for total_hours in user_totals.values],  # Display total hours (rounded)
+        mode='text',
+        textposition='middle right',
+        textfont=dict(size=12, color="black"),
+        hoverinfo='skip',
+        showlegend=False
+    ))
 
-    # Display the plot in Streamlit
-    st.plotly_chart(fig, use_container_width=True)
+    return fig
 
 
+@timed('chart')
 def display_user_hours_table(MP):
     # Compute required columns
-    user_hours_table = MP.groupby('User').agg(
+    user_hours_table = MP.groupby('User', observed=True).agg(
         User_Primary_Hours=('User Primary Hours', 'first'),
         User_Marketing_Hours=('User Marketing Hours', 'first'),
         User_Total_Hours=('User Total Hours', 'first')
@@ -425,20 +2613,117 @@ def display_user_hours_table(MP):
     st.write("### User Hours Table")
     st.dataframe(user_hours_table, use_container_width=True)
 
+DATA_VIEWER_PAGE_SIZES = [25, 50, 100, 500]
+
+
+# Raw exports of a period. Nothing is loaded or sent to the browser until "Load data" is switched on.
+# Runs as a fragment, so the viewer's widgets only rerun the viewer
+# RR_simple_columns/MP_simple_columns add the "Simple View" checkbox that limits the columns shown
+@st.experimental_fragment
+def data_viewer(conn, practice, period, RR_simple_columns=None, MP_simple_columns=None):
+    if not st.toggle('Load data', value=False):
+        return
+
+    MP, RR = load_period(conn, practice, period)
+
+    simple_view = False
+    if RR_simple_columns or MP_simple_columns:
+        simple_view = st.checkbox('Simple View', value=True)
+
+    # Add separate Data Viewer to view data without editing it
+    st.subheader('Data Viewer (Revenue Report)')
+    paginated_table(RR, 'RR', RR_simple_columns if simple_view else None)
+
+    st.subheader('Data Viewer (Matter Productivity by User)')
+    paginated_table(MP, 'MP', MP_simple_columns if simple_view else None)
+
+    # The whole exports, not only the filtered page
+    st.subheader('Export')
+    export_downloads({'RR': RR, 'MP': MP}, 'raw', f'{practice}_{period}')
+
+
+# Shows one page of df. Column selection, filtering and sorting are done here on the server,
+# only the rows of the visible page are sent to the browser
+@timed('chart')
+def paginated_table(df, key, columns=None):
+    columns = [column for column in (columns or df.columns)
+               if column in df.columns]
+
+    settings_left, settings_middle, settings_right = st.columns(3)
+    with settings_left:
+        shown_columns = st.multiselect(
+            'Columns', columns, default=columns, key=f'{key}_columns') or columns
+        page_size = st.selectbox(
+            'Rows per page', DATA_VIEWER_PAGE_SIZES, key=f'{key}_page_size')
+    with settings_middle:
+        filter_column = st.selectbox(
+            'Filter column', [None] + columns, key=f'{key}_filter_column',
+            format_func=_column_label)
+        filter_text = st.text_input(
+            'Contains', key=f'{key}_filter_text', disabled=filter_column is None)
+    with settings_right:
+        sort_column = st.selectbox(
+            'Sort by', [None] + columns, key=f'{key}_sort_column',
+            format_func=_column_label)
+        descending = st.checkbox(
+            'Descending', key=f'{key}_descending', disabled=sort_column is None)
+
+    # Positions of the matching rows, in display order
+    positions = np.arange(len(df))
+    if filter_column is not None and filter_text:
+        positions = positions[_contains_mask(df[filter_column], filter_text)]
+    if sort_column is not None:
+        order = df[sort_column].iloc[positions].reset_index(drop=True).sort_values(
+            ascending=not descending, kind='stable', na_position='last').index
+        positions = positions[order]
+
+    page_count = max(1, -(-len(positions) // page_size))
+    page = st.number_input(f'Page (of {page_count})', min_value=1,
+                           max_value=page_count, value=1, key=f'{key}_page')
+    start = (page - 1) * page_size
+    page_positions = positions[start:start + page_size]
+
+    st.dataframe(df.iloc[page_positions][shown_columns],
+                 hide_index=True, use_container_width=True)
+    st.caption(
+        f'Rows {min(start + 1, len(positions))}–{start + len(page_positions)} of {len(positions)} (total {len(df)})')
+
+
+def _column_label(column):
+    return '—' if column is None else column
+
+
+# Case-insensitive substring match of a column
+# Categoricals are matched on their categories, so the check runs once per distinct value
+def _contains_mask(values, text):
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        categories = values.cat.categories
+        matching = categories[categories.astype(str).str.contains(
+            text, case=False, regex=False)]
+        return values.isin(matching).to_numpy()
+    return values.astype(str).str.contains(text, case=False, regex=False).to_numpy()
+
 #######################################
 # DYNAMIC REPORT VISUALS QUARTERS
 #######################################
 
 
-def visualize_salaries_vs_revenue(df, revenue_column, salary_column):
+@timed('chart')
+def visualize_salaries_vs_revenue(df, revenue_column, salary_column, currency='USD'):
     """
     This function visualizes the relationship between total salaries and total revenue across quarters.
     It creates a bar chart using Plotly and displays it using Streamlit.
-    It includes percentage change annotations for total revenue and salaries compared to the previous quarter.
+    It includes percentage change labels for total revenue and salaries compared to the previous quarter.
 
     Parameters:
     df (pd.DataFrame): A DataFrame containing the columns: 'quarter', 'total_salaries', and 'total_revenue'.
     """
+    # Display the figure in Streamlit
+    st.plotly_chart(cached_figure(_salaries_vs_revenue_figure,
+                    df, revenue_column, salary_column, currency))
+
+
+def _salaries_vs_revenue_figure(df, revenue_column, salary_column, currency='USD'):
     # Sort the dataframe by quarter to ensure the percentage change is correct
     df = df.sort_values(
         by='quarter',
@@ -456,62 +2741,35 @@ def visualize_salaries_vs_revenue(df, revenue_column, salary_column):
     # Create the Plotly figure with slim bars
     fig = px.bar(df_melted, x='quarter', y='Amount', color='Metric',
                  barmode='group', title='Total Salaries vs Total Revenue by Quarter',
-                 labels={'Amount': 'Amount (USD)', 'quarter': 'Quarter'},
+                 labels={'Amount': f'Amount ({currency})', 'quarter': 'Quarter'},
                  color_discrete_map={salary_column: 'red'})  # Red for salaries
 
     # Adjust the bar width for slimmer columns
     fig.update_traces(width=0.3)
 
-    # Add percentage change annotations for both revenue and salaries
-    for i, row in df.iterrows():
-        # Skip the first row since it doesn't have a previous quarter
-        if i == 0 or pd.isna(row['revenue_pct_change']) or pd.isna(row['salaries_pct_change']):
-            continue
-
-        # Format the percentage change with '+' or '-' sign
-        revenue_pct_change_str = f"{'+' if row['revenue_pct_change'] > 0 else ''}{row['revenue_pct_change']:.2f}%"
-        salaries_pct_change_str = f"{'+' if row['salaries_pct_change'] > 0 else ''}{row['salaries_pct_change']:.2f}%"
+    # Percentage change labels above the bars, one label list per series
+    # The first quarter has no previous quarter, so it gets no label (as any quarter with a missing change)
+    has_change = df['revenue_pct_change'].notna() & df['salaries_pct_change'].notna()
+    if len(has_change):
+        has_change.iloc[0] = False
 
-        # Add an annotation (rectangular box) above the revenue bar
-        fig.add_annotation(
-            x=i + 0.2,
-            # Position the annotation above the revenue bar
-            y=row[revenue_column] * 1.1,
-            text=revenue_pct_change_str,
-            showarrow=False,
-            font=dict(size=12, color="black"),
-            align="center",
-            bordercolor="black",
-            borderwidth=1,
-            borderpad=4,  # Padding inside the box
-            bgcolor="white",  # Box background color
-            opacity=0.9
-        )
+    def pct_change_labels(pct_change):
+        return [f"{'+' if value > 0 else ''}{value:.2f}%" if labelled else ''
+                for value, labelled in zip(pct_change, has_change)]
 
-        # Add an annotation (rectangular box) above the salaries bar
-        fig.add_annotation(
-            x=i - 0.2,
-            # Position the annotation above the salaries bar
-            y=row[salary_column] * 1.3,
-            text=salaries_pct_change_str,
-            showarrow=False,
-            font=dict(size=12, color="black"),
-            align="center",
-            bordercolor="black",
-            borderwidth=1,
-            borderpad=4,  # Padding inside the box
-            bgcolor="white",  # Box background color
-            opacity=0.9
-        )
+    labels = {revenue_column: pct_change_labels(df['revenue_pct_change']),
+              salary_column: pct_change_labels(df['salaries_pct_change'])}
+    fig.for_each_trace(lambda trace: trace.update(
+        text=labels[trace.name], textposition='outside', textfont=dict(size=12, color="black")))
 
     # Customize the layout
-    fig.update_layout(xaxis_title='Quarter', yaxis_title='Amount (USD)',
+    fig.update_layout(xaxis_title='Quarter', yaxis_title=f'Amount ({currency})',
                       legend_title='Metric')
 
-    # Display the figure in Streamlit
-    st.plotly_chart(fig)
+    return fig
 
 
+@timed('chart')
 def visualize_cost_vs_collected_time_v1(df, salary_column, collected_time_column):
 
     # Create the bar plot
@@ -546,6 +2804,7 @@ def visualize_cost_vs_collected_time_v1(df, salary_column, collected_time_column
     st.plotly_chart(fig)
 
 
+@timed('chart')
 def visualize_cost_vs_collected_time_v2(df, salary_column, collected_time_column):
     # Create the bar plot
     fig = px.bar(df,
@@ -574,6 +2833,7 @@ def visualize_cost_vs_collected_time_v2(df, salary_column, collected_time_column
     st.plotly_chart(fig)
 
 
+@timed('chart')
 def visualize_cost_vs_collected_time_v3(df, salary_column, collected_time_column):
     # Create the bar plot
     fig = px.bar(df,
@@ -600,6 +2860,7 @@ def visualize_cost_vs_collected_time_v3(df, salary_column, collected_time_column
     st.plotly_chart(fig)
 
 
+@timed('chart')
 def visualize_cost_vs_collected_time_v4(df, collected_time_column):
     # Assign specific colors to each practice area for consistency across quarters
     # color_discrete_map = {
@@ -612,7 +2873,7 @@ def visualize_cost_vs_collected_time_v4(df, collected_time_column):
     # }
 
     # Create the bar plot
-    df = df.groupby(['Practice Area', 'Quarter'], as_index=False)[
+    df = df.groupby(['Practice Area', 'Quarter'], as_index=False, observed=True)[
         collected_time_column].sum()
     
     fig = px.bar(
@@ -639,7 +2900,17 @@ def visualize_cost_vs_collected_time_v4(df, collected_time_column):
     st.plotly_chart(fig)
 
 # current version
-def visualize_cost_vs_collected_time_v5(df, salary_column, collected_time_column):
+@timed('chart')
+def visualize_cost_vs_collected_time_v5(df, salary_column, collected_time_column, currency='USD'):
+    # Render
+    st.plotly_chart(cached_figure(_cost_vs_collected_time_v5_figure,
+                    df, salary_column, collected_time_column, currency))
+
+
+def _cost_vs_collected_time_v5_figure(df, salary_column, collected_time_column, currency='USD'):
+    # Work on a copy, the caller's frame is also used by other charts
+    df = df.copy()
+
     # --- Create sortable quarter components ---
     df[['Q', 'Y']] = df['Quarter'].str.split('_', expand=True)
     df['Y'] = df['Y'].astype(int)
@@ -658,9 +2929,9 @@ def visualize_cost_vs_collected_time_v5(df, salary_column, collected_time_column
         y=collected_time_column,
         color='Quarter',
         barmode='group',
-        title='USD Collected Time by Practice Area and Quarter',
+        title=f'{currency} Collected Time by Practice Area and Quarter',
         labels={
-            collected_time_column: 'USD Collected Time',
+            collected_time_column: f'{currency} Collected Time',
             'Practice Area': 'Practice Area'
         },
         height=500
@@ -668,21 +2939,57 @@ def visualize_cost_vs_collected_time_v5(df, salary_column, collected_time_column
 
     # Layout tweaks
     fig.update_layout(
-        yaxis_title='USD Collected Time',
+        yaxis_title=f'{currency} Collected Time',
         showlegend=True,
     )
 
     fig.update_xaxes(title_text="Practice Area")
 
-    # Render
-    st.plotly_chart(fig)
-
+    return fig
+
+# Revenue and salaries of a practice by quarter, from the firm-wide dynamic store
+def practice_trend(conn, practice):
+    st.subheader('Trend')
+    trend_table = practice_trend_table(conn, practice)
+    if trend_table is None or trend_table.empty:
+        st.info('No trend data yet, it is built from "Refresh firm-wide data" on the Dynamic Reports page', icon='ℹ️')
+        return
+
+    visualize_salaries_vs_revenue(trend_table, revenue_column='total_collected_time', salary_column='total_salaries',
+                                  currency=PRACTICES[practice]['currency_label'].strip())
+
+
+# Practice areas of a practice by quarter from the firm-wide details
+# Only the rows of the practice and the three columns of the chart are downloaded
+def practice_areas_trend(conn, practice):
+    revenue_column = PRACTICES[practice]['revenue_column']
+    salary_column = PRACTICES[practice]['salary_column']
+    try:
+        details = load_dynamic_details(conn, DYNAMIC_FOLDER_PATH, FIRM_DYNAMIC_FILE_NAME, practices=[practice],
+                                       columns=['Practice Area', salary_column, revenue_column])
+    except FileNotFoundError:
+        details = {}
+    if not details.get(practice):
+        st.info('No trend data yet, it is built from "Refresh firm-wide data" on the Dynamic Reports page', icon='ℹ️')
+        return
+
+    full_table, _ = pkl_to_two_dfs(details[practice])
+    visualize_cost_vs_collected_time_v5(full_table, salary_column=salary_column, collected_time_column=revenue_column,
+                                        currency=PRACTICES[practice]['currency_label'].strip())
 
 #######################################
 # DYNAMIC REPORT VISUALS YEARS
 #######################################
+@timed('chart')
 def visualize_years_stacked(yearly):
-    
+    # Render
+    st.plotly_chart(cached_figure(_years_stacked_figure, yearly))
+
+
+def _years_stacked_figure(yearly):
+    # Work on a copy, the caller's frame is also used by other charts
+    yearly = yearly.copy()
+
     # Extract year and quarter components
     yearly['Year'] = yearly['Quarter'].str.split('_').str[1].astype(int)
     yearly['Q'] = yearly['Quarter'].str.split('_').str[0]
@@ -693,7 +3000,7 @@ def visualize_years_stacked(yearly):
 
     # Aggregate per year + quarter
     q_agg = (
-        yearly.groupby(['Year', 'Q'])
+        yearly.groupby(['Year', 'Q'], observed=True)
             .agg({
                 'USD Collected Time': 'sum',
                 'Matter Cost in Salary': 'sum'
@@ -752,10 +3059,19 @@ def visualize_years_stacked(yearly):
         legend_title="Breakdown"
     )
 
-    # Render
-    st.plotly_chart(fig)
+    return fig
+
 
+@timed('chart')
 def visualize_waterfall(yearly):
+    # Render
+    st.plotly_chart(cached_figure(_waterfall_figure, yearly))
+
+
+def _waterfall_figure(yearly):
+    # Work on a copy, the caller's frame is also used by other charts
+    yearly = yearly.copy()
+
     # --- Prepare yearly totals ---
     yearly['Year'] = yearly['Quarter'].str.split(
         '_').str[1]  # .astype(int).round(0)
@@ -816,5 +3132,4 @@ def visualize_waterfall(yearly):
         margin=dict(l=40, r=40, t=60, b=40)
     )
 
-    # Render
-    st.plotly_chart(fig)
+    return fig
@@ -2,7 +2,6 @@
 When a new practice report is being coded, it is neccessary to modify the first three sections in this file
 """
 
-from st_files_connection import FilesConnection
 import streamlit as st
 from custom_functions import *
 
@@ -17,6 +16,9 @@ st.set_page_config(
     layout='wide'
 )
 
+# Stage timings of every run are collected for the diagnostics panel at the bottom
+start_page_run('Management')
+
 # Setting a title
 st.title('Clio Reports Analyzer')
 st.subheader('Management report')
@@ -38,8 +40,10 @@ page_allowed_emails = st.secrets["management_emails"]
 
 authenticate(st.experimental_user.email, page_allowed_emails) # Stops the app if the email is not in the allowed list
 
-# Create connection object and retrieve file contents.
-conn = st.connection('gcs', type=FilesConnection)
+# Create connection object and retrieve file contents (GCS unless another storage backend is configured, see get_connection)
+conn = get_connection()
+# Loads the latest periods of every practice into the shared cache in the background, once per server process
+start_prewarm(conn)
 
 #######################################
 # PRACTICE FOLDER PATH, CURRENCY
@@ -47,11 +51,12 @@ conn = st.connection('gcs', type=FilesConnection)
 
 # !! This section is modified for every practice
 
-folder_path = "clio-reports/management"
+practice = 'management'
+folder_path = practice_folder(practice)
 
-revenue_column = 'USD Collected Time'
-salary_column = 'Matter Cost in Salary'
-currency_label = ' USD'
+revenue_column = PRACTICES[practice]['revenue_column']
+salary_column = PRACTICES[practice]['salary_column']
+currency_label = PRACTICES[practice]['currency_label']
 
 #######################################
 # PERIOD AND DATA LOADING FROM CLOUD
@@ -71,22 +76,20 @@ selected_quarter = st.selectbox(
 
 chosen_period = f"{selected_quarter}_{selected_year}"
 
+# The cached period list may be older than a fresh upload, check the bucket again before giving up
+# (the folder is listed at most once per PERIOD_CATALOG_TTL, whatever the number of sessions asking)
+if chosen_period not in periods_list:
+    refresh_period_catalog(conn, folder_path)
+    periods_list = create_periods_list(conn, folder_path)
+
 # Check if this period actually exists in cloud data
 if chosen_period not in periods_list:
     st.warning("No data available for this period")
     st.stop()
 else:
-    # Load from cloud
-    MP = conn.read(
-        f"{folder_path}/{chosen_period}/MP_{chosen_period}.csv",
-        input_format="csv",
-        ttl=600
-    )
-    RR = conn.read(
-        f"{folder_path}/{chosen_period}/RR_{selected_quarter}_{selected_year}.csv",
-        input_format="csv",
-        ttl=600
-    )
+    # Load from cloud: aggregates used by the dashboard, computed once per period and cached until the files change
+    # The raw exports are only loaded by the Data Viewer
+    cube = load_period_cube(conn, practice, chosen_period)
 
 # # Get the desired period
 # periods_list = create_periods_list(conn, folder_path)
@@ -105,12 +108,7 @@ else:
 #######################################
 
 with st.expander("Data Viewer"):
-    # Add separate Data Viewer to view data without editing it
-    st.subheader('Data Viewer (Revenue Report)')
-    st.write(RR) #было new_RR когда было с Editor
-
-    st.subheader('Data Viewer (Matter Productivity by User)')
-    st.write(MP)
+    data_viewer(conn, practice, chosen_period)
 
 st.title('Dashboard')
 
@@ -119,7 +117,8 @@ st.title('Dashboard')
 #######################################
 
 try:
-    mt = create_margin_table(RR, MP, revenue_column, salary_column)
+    mt = cube_margin_table(
+        cube['revenue'], cube['salary'], revenue_column, salary_column)
 except:
     st.info('Something went wrong (MT)', icon='ℹ️')
     st.stop()
@@ -152,15 +151,33 @@ with middle_right_line:
     with st.container(border=True):
         show_margin_table(mt, salary_column,
                           revenue_column, currency_label)
+        export_downloads({'Margin table': mt}, 'margin_table',
+                         f'margin_table_{practice}_{chosen_period}')
 
 
-client_contribution(RR, revenue_column)
+client_contribution(cube['revenue'], revenue_column)
 
 
-hours_by_practice(MP)
+hours_by_practice(cube['salary'])
 
 
 try:
-    display_user_hours_table(MP)
+    display_user_hours_table(cube['user_hours'])
 except:
-    st.info('No hours table avaliable', icon='ℹ️')
\ No newline at end of file
+    st.info('No hours table avaliable', icon='ℹ️')
+
+
+#######################################
+# TREND
+#######################################
+
+# Quarterly revenue and salaries of the practice, read from the firm-wide dynamic store
+practice_trend(conn, practice)
+
+
+#######################################
+# DIAGNOSTICS
+#######################################
+
+# Stage timings and cache statistics of the server, only shown to management
+diagnostics_panel()
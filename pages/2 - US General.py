@@ -1,4 +1,3 @@
-from st_files_connection import FilesConnection
 import streamlit as st
 from custom_functions import *
 
@@ -13,6 +12,9 @@ st.set_page_config(
     layout='wide'
 )
 
+# Stage timings of every run are collected for the diagnostics panel at the bottom
+start_page_run('US General')
+
 # Setting a title
 st.title('Clio Reports Analyzer')
 st.subheader('US General practice report')
@@ -33,8 +35,10 @@ page_allowed_emails = st.secrets["us_general_emails"] + \
 # Stops the app if the email is not in the allowed list
 authenticate(st.experimental_user.email, page_allowed_emails)
 
-# Create connection object and retrieve file contents.
-conn = st.connection('gcs', type=FilesConnection)
+# Create connection object and retrieve file contents (GCS unless another storage backend is configured, see get_connection)
+conn = get_connection()
+# Loads the latest periods of every practice into the shared cache in the background, once per server process
+start_prewarm(conn)
 
 # st.info('TBA')
 # st.stop()
@@ -45,11 +49,12 @@ conn = st.connection('gcs', type=FilesConnection)
 
 # !! This section is modified for every practice
 
-folder_path = "clio-reports/us_general"
+practice = 'us_general'
+folder_path = practice_folder(practice)
 
-revenue_column = 'USD Collected Time'
-salary_column = 'Matter Cost in Salary'
-currency_label = ' USD'
+revenue_column = PRACTICES[practice]['revenue_column']
+salary_column = PRACTICES[practice]['salary_column']
+currency_label = PRACTICES[practice]['currency_label']
 
 #######################################
 # PERIOD AND DATA LOADING FROM CLOUD
@@ -69,34 +74,27 @@ selected_quarter = st.selectbox(
 
 chosen_period = f"{selected_quarter}_{selected_year}"
 
+# The cached period list may be older than a fresh upload, check the bucket again before giving up
+# (the folder is listed at most once per PERIOD_CATALOG_TTL, whatever the number of sessions asking)
+if chosen_period not in periods_list:
+    refresh_period_catalog(conn, folder_path)
+    periods_list = create_periods_list(conn, folder_path)
+
 # Check if this period actually exists in cloud data
 if chosen_period not in periods_list:
     st.warning("No data available for this period")
     st.stop()
 else:
-    # Load from cloud
-    MP = conn.read(
-        f"{folder_path}/{chosen_period}/MP_{chosen_period}.csv",
-        input_format="csv",
-        ttl=600
-    )
-    RR = conn.read(
-        f"{folder_path}/{chosen_period}/RR_{selected_quarter}_{selected_year}.csv",
-        input_format="csv",
-        ttl=600
-    )
+    # Load from cloud: aggregates used by the dashboard, computed once per period and cached until the files change
+    # The raw exports are only loaded by the Data Viewer
+    cube = load_period_cube(conn, practice, chosen_period)
 
 #######################################
 # DATA VIEWING
 #######################################
 
 with st.expander("Data Viewer"):
-    # Add separate Data Viewer to view data without editing it
-    st.subheader('Data Viewer (Revenue Report)')
-    st.write(RR)  # было new_RR когда было с Editor
-
-    st.subheader('Data Viewer (Matter Productivity by User)')
-    st.write(MP)
+    data_viewer(conn, practice, chosen_period)
 
 st.title('Dashboard')
 
@@ -105,7 +103,8 @@ st.title('Dashboard')
 #######################################
 
 try:
-    mt = create_margin_table(RR, MP, revenue_column, salary_column)
+    mt = cube_margin_table(
+        cube['revenue'], cube['salary'], revenue_column, salary_column)
 except:
     st.info('Something went wrong (MT)', icon='ℹ️')
     st.stop()
@@ -139,7 +138,25 @@ with middle_right_line:
     with st.container(border=True):
         show_margin_table(mt, salary_column,
                           revenue_column, currency_label)
+        export_downloads({'Margin table': mt}, 'margin_table',
+                         f'margin_table_{practice}_{chosen_period}')
+
+client_contribution(cube['revenue'], revenue_column)
+
+hours_by_practice(cube['salary'])
+
 
-client_contribution(RR, revenue_column)
+#######################################
+# TREND
+#######################################
+
+# Quarterly revenue and salaries of the practice, read from the firm-wide dynamic store
+practice_trend(conn, practice)
+
+
+#######################################
+# DIAGNOSTICS
+#######################################
 
-hours_by_practice(MP)
+# Stage timings and cache statistics of the server, only shown to management
+diagnostics_panel()
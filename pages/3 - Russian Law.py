@@ -1,4 +1,3 @@
-from st_files_connection import FilesConnection
 import streamlit as st
 from custom_functions import *
 
@@ -13,6 +12,9 @@ st.set_page_config(
     layout='wide'
 )
 
+# Stage timings of every run are collected for the diagnostics panel at the bottom
+start_page_run('Russian Law')
+
 # Setting a title
 st.title('Clio Reports Analyzer')
 st.subheader('Russian Law')
@@ -33,8 +35,10 @@ page_allowed_emails = st.secrets["russian_law_emails"] + \
 # Stops the app if the email is not in the allowed list
 authenticate(st.experimental_user.email, page_allowed_emails)
 
-# Create connection object and retrieve file contents.
-conn = st.connection('gcs', type=FilesConnection)
+# Create connection object and retrieve file contents (GCS unless another storage backend is configured, see get_connection)
+conn = get_connection()
+# Loads the latest periods of every practice into the shared cache in the background, once per server process
+start_prewarm(conn)
 
 #######################################
 # PRACTICE FOLDER PATH, CURRENCY
@@ -42,11 +46,12 @@ conn = st.connection('gcs', type=FilesConnection)
 
 # !! This section is modified for every practice
 
-folder_path = "clio-reports/russian_law"
+practice = 'russian_law'
+folder_path = practice_folder(practice)
 
-revenue_column = 'RUB Collected Time'
-salary_column = 'RUB Matter Cost in Salary'
-currency_label = ' RUB'
+revenue_column = PRACTICES[practice]['revenue_column']
+salary_column = PRACTICES[practice]['salary_column']
+currency_label = PRACTICES[practice]['currency_label']
 
 #######################################
 # PERIOD AND DATA LOADING FROM CLOUD
@@ -65,22 +70,20 @@ selected_quarter = st.selectbox(
 
 chosen_period = f"{selected_quarter}_{selected_year}"
 
+# The cached period list may be older than a fresh upload, check the bucket again before giving up
+# (the folder is listed at most once per PERIOD_CATALOG_TTL, whatever the number of sessions asking)
+if chosen_period not in periods_list:
+    refresh_period_catalog(conn, folder_path)
+    periods_list = create_periods_list(conn, folder_path)
+
 # Check if this period actually exists in cloud data
 if chosen_period not in periods_list:
     st.warning("No data available for this period")
     st.stop()
 else:
-    # Load from cloud
-    MP = conn.read(
-        f"{folder_path}/{chosen_period}/MP_{chosen_period}.csv",
-        input_format="csv",
-        ttl=600
-    )
-    RR = conn.read(
-        f"{folder_path}/{chosen_period}/RR_{selected_quarter}_{selected_year}.csv",
-        input_format="csv",
-        ttl=600
-    )
+    # Load from cloud: aggregates used by the dashboard, computed once per period and cached until the files change
+    # The raw exports are only loaded by the Data Viewer
+    cube = load_period_cube(conn, practice, chosen_period)
 
 #######################################
 # DATA VIEWING
@@ -88,71 +91,81 @@ else:
 
 
 with st.expander("Data Viewer"):
-
-    simple_view = st.checkbox('Simple View', value=True)
-
-    # Add separate Data Viewer to view data without editing it
-    st.subheader('Data Viewer (Revenue Report)')
-    if simple_view:
-        st.write(RR[['Client', 'Matter Number',
-                 'Matter Description', revenue_column, 'Currency', 'Collected Time']])
-    else:
-        st.write(RR)
-
-    st.subheader('Data Viewer (Matter Productivity by User)')
-    if simple_view:
-        st.write(MP[['User', 'Matter Number', 'Date', 'Quantity', salary_column]])
-    else:
-        st.write(MP)
-
-with st.expander("Settings"):
-    damen_counted = st.checkbox('Учитывать DESP Sale', value=True)
-    if damen_counted:
-        pass
-    else:
-        RR = RR[RR['Client'] != 'Damen Global Support B.V.']
-
-st.title('Dashboard')
+    data_viewer(conn, practice, chosen_period,
+                RR_simple_columns=['Client', 'Matter Number',
+                                   'Matter Description', revenue_column, 'Currency', 'Collected Time'],
+                MP_simple_columns=['User', 'Matter Number', 'Date', 'Quantity', salary_column])
 
 #######################################
-# GETTING DATA THAT IS USED LATER
+# STREAMLIT LAYOUT AND PLOTTING
 #######################################
 
-try:
-    mt = create_margin_table(RR, MP, revenue_column, salary_column)
-except:
-    st.info('Something went wrong (MT)', icon='ℹ️')
-    st.stop()
-total_collected_time = mt[revenue_column].sum()
-total_salaries = mt[salary_column].sum()
+# Runs as a fragment: the DESP Sale setting and the client chart only rerun the revenue part of the dashboard
+@st.experimental_fragment
+def revenue_dashboard(cube, revenue_column, salary_column, currency_label):
+    with st.expander("Settings"):
+        damen_counted = st.checkbox('Учитывать DESP Sale', value=True)
+        revenue_cube = cube['revenue']
+        if damen_counted:
+            pass
+        else:
+            revenue_cube = revenue_cube[revenue_cube['Client'] != 'Damen Global Support B.V.']
+
+    st.title('Dashboard')
+
+    try:
+        mt = cube_margin_table(
+            revenue_cube, cube['salary'], revenue_column, salary_column)
+    except:
+        st.info('Something went wrong (MT)', icon='ℹ️')
+        st.stop()
+    total_collected_time = mt[revenue_column].sum()
+    total_salaries = mt[salary_column].sum()
+
+    top_left_line, top_right_line = st.columns((2, 2))
+    middle_left_line, middle_right_line = st.columns((1.8, 1.5), gap="medium")
+    # lower_left_line, lower_right_line = st.columns(2, gap="medium")
+
+    with top_left_line:
+        with st.container(border=True):
+            plot_metric("Revenue", total_collected_time,
+                        prefix="", suffix=currency_label)
+
+    with top_right_line:
+        with st.container(border=True):
+            plot_metric("Total Salaries", total_salaries,
+                        prefix="", suffix=currency_label)
+
+    with middle_left_line:
+        with st.container(border=True):
+            plot_chart_salary_and_collected_time(
+                mt, salary_column, revenue_column, currency_label)
+
+    with middle_right_line:
+        with st.container(border=True):
+            show_margin_table(mt, salary_column,
+                              revenue_column, currency_label)
+            export_downloads({'Margin table': mt}, 'margin_table',
+                             f'margin_table_{practice}_{chosen_period}')
+
+    render_client_contribution(revenue_cube, revenue_column)
+
+
+revenue_dashboard(cube, revenue_column, salary_column, currency_label)
+hours_by_practice(cube['salary'])
+
 
 #######################################
-# STREAMLIT LAYOUT AND PLOTTING
+# TREND
 #######################################
 
-top_left_line, top_right_line = st.columns((2, 2))
-middle_left_line, middle_right_line = st.columns((1.8, 1.5), gap="medium")
-# lower_left_line, lower_right_line = st.columns(2, gap="medium")
+# Quarterly revenue and salaries of the practice, read from the firm-wide dynamic store
+practice_trend(conn, practice)
 
-with top_left_line:
-    with st.container(border=True):
-        plot_metric("Revenue", total_collected_time,
-                    prefix="", suffix=currency_label)
 
-with top_right_line:
-    with st.container(border=True):
-        plot_metric("Total Salaries", total_salaries,
-                    prefix="", suffix=currency_label)
-
-with middle_left_line:
-    with st.container(border=True):
-        plot_chart_salary_and_collected_time(
-            mt, salary_column, revenue_column, currency_label)
-
-with middle_right_line:
-    with st.container(border=True):
-        show_margin_table(mt, salary_column,
-                          revenue_column, currency_label)
+#######################################
+# DIAGNOSTICS
+#######################################
 
-client_contribution(RR, revenue_column)
-hours_by_practice(MP)
+# Stage timings and cache statistics of the server, only shown to management
+diagnostics_panel()
@@ -3,7 +3,6 @@ When a new practice report is being coded, it is neccessary to modify the first
 """
 
 import logging
-from st_files_connection import FilesConnection
 import streamlit as st
 from custom_functions import *
 
@@ -18,6 +17,9 @@ st.set_page_config(
     layout='wide'
 )
 
+# Stage timings of every run are collected for the diagnostics panel at the bottom
+start_page_run('Dynamic Reports')
+
 # Setting a title
 st.title('Dynamic Reports')
 
@@ -36,8 +38,8 @@ page_allowed_emails = st.secrets["management_emails"]
 # Stops the app if the email is not in the allowed list
 authenticate(st.experimental_user.email, page_allowed_emails)
 
-# Create connection object and retrieve file contents.
-conn = st.connection('gcs', type=FilesConnection)
+# Create connection object and retrieve file contents (GCS unless another storage backend is configured, see get_connection)
+conn = get_connection()
 
 #######################################
 # PRACTICE FOLDER PATH, CURRENCY
@@ -53,19 +55,21 @@ currency_label = ' USD'
 
 folder_path = "clio-reports/management"
 dynamic_folder_path = "clio-reports/dynamic"
-dynamic_file_name = 'dynamic_data.pkl'
+dynamic_file_name = 'dynamic_data.parquet'
+# Years of the practice area and yearly reports until others are chosen
+default_years = 2
 
 #######################################
 # PERIOD AND DATA LOADING FROM CLOUD
 #######################################
 st.subheader('Quarterly reports')
-# Get all the periods
-periods_list = create_periods_list(conn, folder_path)
+
+# Last refresh of the store by this server (None if there was none)
+refresh_job = dynamic_refresh_job(folder_path, dynamic_folder_path, dynamic_file_name)
 
 try:
-    # Attempt to read Pickle data from GCS
-    with conn.fs.open(f"{dynamic_folder_path}/{dynamic_file_name}", 'rb') as f:
-        pkl_data = pickle.load(f)
+    # Attempt to read the summary index (per-quarter totals) from GCS, the details are loaded further down on demand
+    short_table = load_dynamic_summary(conn, dynamic_folder_path, dynamic_file_name)
     # If successful, display success message
     # st.success('Data retrieved from dynamic cloud')
 
@@ -75,38 +79,34 @@ except Exception as e:
     # Optionally, log the error for further investigation
     logging.error(f"Error retrieving data from GCS: {e}")
 
-    # If not found, then the data is retrieved and written to the cloud
-    logging.error(
-        f"File with dynamic data is not found. Initiating data retrieval")
-    plk_data = refresh_and_upload_data(periods_list, folder_path, revenue_column,
-             salary_column, dynamic_folder_path, dynamic_file_name, conn)
-
-if st.button('Refresh Data'):
-    plk_data = refresh_and_upload_data(periods_list, folder_path, revenue_column,
-                 salary_column, dynamic_folder_path, dynamic_file_name, conn)
-
-full_table, short_table = pkl_to_two_dfs(pkl_data)
+    # If not found, then the data is retrieved and written to the cloud in the background
+    # A refresh that already ran is not started again by the reload, its outcome is shown and only the button retries
+    if refresh_job is None:
+        logging.error(
+            f"File with dynamic data is not found. Initiating data retrieval")
+        start_refresh_job(conn, folder_path, revenue_column, salary_column,
+                          dynamic_folder_path, dynamic_file_name)
+    elif not refresh_job.running and st.button('Refresh Data'):
+        start_refresh_job(conn, folder_path, revenue_column, salary_column,
+                          dynamic_folder_path, dynamic_file_name)
+    refresh_status(folder_path, dynamic_folder_path, dynamic_file_name)
+    st.stop()
+
+# Only new or re-uploaded periods are recomputed. The refresh runs in the background, the page stays usable
+# and reloads when the new data is published
+if st.button('Refresh Data', disabled=refresh_job is not None and refresh_job.running):
+    start_refresh_job(conn, folder_path, revenue_column, salary_column,
+                      dynamic_folder_path, dynamic_file_name)
+refresh_status(folder_path, dynamic_folder_path, dynamic_file_name)
 
 short_table = short_table.sort_values(
     by="quarter",
     key=lambda col: col.map(quarter_sort_key)
 ).reset_index(drop=True)
 
-full_table = full_table[full_table['Practice Area'] != 'Internal Projects'].sort_values(
-    by="Quarter",
-    key=lambda col: col.map(quarter_sort_key)
-).reset_index(drop=True)
-st.write(full_table.rename(columns={'Matter Cost in Salary': 'Cost in Salary'}))
-
-yearly_table = build_yearly_table(full_table)
-
 #######################################
 # VISUALISATION QUARTERS
-####################################### 
-
-# version of v3 with right sorting
-visualize_cost_vs_collected_time_v5(
-    full_table, salary_column='Matter Cost in Salary', collected_time_column='USD Collected Time')
+#######################################
 
 st.write(short_table.rename(
     columns={'quarter': 'Quarter', 'total_collected_time': 'Revenue', 'total_salaries': 'Cost in Salary'}))
@@ -114,13 +114,79 @@ st.write(short_table.rename(
 visualize_salaries_vs_revenue(
     short_table, revenue_column='total_collected_time', salary_column='total_salaries')
 
+#######################################
+# PRACTICE AREAS AND YEARS
+#######################################
+
+# The margin tables are only downloaded when these sections are opened, and only those of the chosen years.
+# Whole years are chosen, so the yearly report never sums part of a year that has more quarters
+pkl_data = None
+full_table = None
+
+if st.toggle('Show practice area and yearly reports', value=False) and len(short_table):
+    years = sorted({quarter_sort_key(quarter)[0] for quarter in short_table['quarter']})
+    first_year, last_year = st.select_slider(
+        'Years', options=years, value=(years[max(0, len(years) - default_years)], years[-1]))
+    chosen_quarters = [quarter for quarter in short_table['quarter']
+                       if first_year <= quarter_sort_key(quarter)[0] <= last_year]
+
+    pkl_data = load_dynamic_details(conn, dynamic_folder_path, dynamic_file_name, periods=chosen_quarters)
+    full_table, _ = pkl_to_two_dfs(pkl_data)
+
+    full_table = full_table[full_table['Practice Area'] != 'Internal Projects'].sort_values(
+        by="Quarter",
+        key=lambda col: col.map(quarter_sort_key)
+    ).reset_index(drop=True)
+
+    st.subheader('Practice areas')
+    st.write(full_table.rename(columns={'Matter Cost in Salary': 'Cost in Salary'}))
+
+    # version of v3 with right sorting
+    visualize_cost_vs_collected_time_v5(
+        full_table, salary_column='Matter Cost in Salary', collected_time_column='USD Collected Time')
+
+    yearly_table = build_yearly_table(full_table)
+
+    st.subheader('Yearly reports')
+    st.write(yearly_table)
+
+    visualize_years_stacked(full_table)
+
+    visualize_waterfall(full_table)
+
+    export_downloads({'Practice areas': full_table, 'Yearly': yearly_table}, 'dynamic', 'dynamic_reports')
 
 #######################################
-# VISUALISATION YEARS
+# FIRM-WIDE TRENDS
 #######################################
-st.subheader('Yearly reports')
-st.write(yearly_table)
 
-visualize_years_stacked(full_table)
+# One store covering every practice folder (each with its own currency and columns), built in one parallel pass
+# The practice pages show their trend from it
+st.subheader('Practice trends')
+
+firm_refresh_job = dynamic_refresh_job(BUCKET_ROOT, dynamic_folder_path, FIRM_DYNAMIC_FILE_NAME)
+if st.button('Refresh firm-wide data', disabled=firm_refresh_job is not None and firm_refresh_job.running):
+    start_firm_refresh_job(conn, dynamic_folder_path, FIRM_DYNAMIC_FILE_NAME)
+refresh_status(BUCKET_ROOT, dynamic_folder_path, FIRM_DYNAMIC_FILE_NAME)
+
+for practice_tab, practice in zip(st.tabs([practice.replace('_', ' ').title() for practice in PRACTICES]), PRACTICES):
+    with practice_tab:
+        practice_trend(conn, practice)
+        if st.toggle('Show practice areas', value=False, key=f'practice_areas_{practice}'):
+            practice_areas_trend(conn, practice)
+
+# The partitioned dataset (when enabled) only gets the periods ingested after it was turned on,
+# the backfill writes the partitions of the older ones. Current partitions are skipped
+if dataset_enabled():
+    backfill_job = dynamic_refresh_job(BUCKET_ROOT, DATASET_ROOT, DATASET_BACKFILL_NAME)
+    if st.button('Backfill dataset', disabled=backfill_job is not None and backfill_job.running):
+        start_dataset_backfill_job(conn)
+    refresh_status(BUCKET_ROOT, DATASET_ROOT, DATASET_BACKFILL_NAME)
+
+
+#######################################
+# DIAGNOSTICS
+#######################################
 
-visualize_waterfall(full_table)
\ No newline at end of file
+# Stage timings and cache statistics of the server, only shown to management
+diagnostics_panel({'dynamic summary': short_table, 'dynamic payload': pkl_data, 'full_table': full_table})